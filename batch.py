@@ -0,0 +1,85 @@
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import numpy as np
+from curve import Curve
+from oas import OASModel, PROCESS_STATS, phaseStats
+
+# the curve of the worker process, set once by _init_worker
+_worker_curve = None
+
+
+def _init_worker(curve: Curve) -> None:
+    global _worker_curve
+    _worker_curve = curve
+
+
+def _oas_task(task: tuple) -> dict:
+    ''' Solve the OAS of one bond on the worker's curve, failures are reported in the result
+    '''
+    bond, value_date, price, credit_spread, profile = task
+    result = {'CUSIP': bond.CUSIP, 'Price': price, 'OAS': None, 'Error': None}
+    model = OASModel()
+    model._profile = profile
+    try:
+        if bond._coupon_schedule is None:
+            bond.calculate_coupon_schedule()
+        oas = model.Calculate_OAS(bond, _worker_curve, value_date, price, credit_spread)
+        if oas == -1 or oas is None or math.isnan(oas):
+            result['Error'] = 'OAS calculation failed'
+        else:
+            result['OAS'] = oas
+    except Exception as e:
+        result['Error'] = f"{type(e).__name__}: {e}"
+    if profile:
+        result['Stats'] = model.get_stats()
+    return result
+
+
+def calculate_oas(bonds: list, value_date: date, prices: list=None, curve: Curve=None,
+                  curve_csv: str=None, credit_spread=0.01, max_workers: int=None, profile: bool=False) -> list:
+    ''' Calculate the OAS of a list of bonds in parallel on a process pool.
+        The curve is sent to every worker once, when the worker starts, and each worker
+        keeps its calibrated trees in its own tree cache.
+        Return:
+          list of dict with CUSIP, Price, OAS and Error, in the order of the bonds.
+          OAS is None and Error is set if the bond failed. With profile, Stats is the
+          phaseStats of the bond, and the stats of the workers are merged in PROCESS_STATS.
+        Params:
+          bonds: list of Bond, e.g. Bond.load_all_bonds()
+          value_date: pricing date (settlement date)
+          prices: market prices, the bonds' ask prices if None
+          curve: the spot Curve, loaded from curve_csv for value_date if None
+          curve_csv: spot curve file, ./data/treasuryspotcurve.csv if None
+          credit_spread: seed of the OAS solver, one for all bonds or a list or array with one per bond,
+                         e.g. the previous day's OAS as a warm start
+          max_workers: number of processes, os.cpu_count() if None
+          profile: time the phases of every OAS calculation, see OASModel.get_stats
+    '''
+    if curve is None:
+        curve = Curve(value_date)
+        curve.load_from_csv(curve_csv or './data/treasuryspotcurve.csv')
+    if prices is None:
+        prices = [bond._market_price for bond in bonds]
+    if len(prices) != len(bonds):
+        raise ValueError(f"{len(bonds)} bonds but {len(prices)} prices")
+
+    if not isinstance(credit_spread, (list, tuple, np.ndarray)):
+        credit_spread = [credit_spread] * len(bonds)
+    if len(credit_spread) != len(bonds):
+        raise ValueError(f"{len(bonds)} bonds but {len(credit_spread)} credit spreads")
+    tasks = [(bond, value_date, price, seed, profile) for bond, price, seed in zip(bonds, prices, credit_spread)]
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(tasks) <= 1:
+        _init_worker(curve)
+        return [_oas_task(task) for task in tasks]
+
+    chunksize = max(1, len(tasks) // (4 * max_workers))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(curve,)) as executor:
+        results = list(executor.map(_oas_task, tasks, chunksize=chunksize))
+    for result in results:
+        # stats of a worker process come back with the result
+        if isinstance(result.get('Stats'), phaseStats):
+            PROCESS_STATS.merge(result['Stats'])
+    return results
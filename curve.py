@@ -1,8 +1,21 @@
-from datetime import date
+import io
+import os
+import json
+import math
+import threading
+import time
+import urllib.request
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
+import numpy as np
 import pandas as pd
+from scipy.optimize import minimize
 from utilities import toDateNumber
 
+# date.toordinal() of date number 0, see toDateNumber
+ORDINAL_OFFSET = date(1899, 12, 31).toordinal()
+
+
 class Curve():
     ''' Curve representation
     '''
@@ -26,13 +39,45 @@ class Curve():
     
     def get_curve_data(self) -> None:
         return self._data
+
+    def cache_key(self) -> tuple:
+        ''' Return:
+              hashable key of the value date, model parameters and curve points
+        '''
+        return (self._valueDateNum, self._compoundFreq, self._ir_vol, self._mean_reversion,
+                tuple((d[2], d[1]) for d in self._data))
     
-    def download_curve(self) -> None:
-        yearmonth = self._valueDate.strftime('%Y%m')
-        url = (f"https://home.treasury.gov/resource-center/data-chart-center/interest-rates/daily-treasury-rates.csv"
-               f"/all/{yearmonth}?type=daily_treasury_yield_curve&field_tdr_date_value_month={yearmonth}&page&_format=csv")
-        df = pd.read_csv(url)
+    def getChangeDate(self, other: 'Curve', interpolate=False) -> float:
+        ''' The first date from which getTheRate of the other curve can differ from this curve,
+            e.g. to reuse a tree calibrated to this curve up to that date
+            Return:
+              date number, the value date if the curves differ in more than their rates,
+              inf if the rates are the same
+        '''
+        if type(self) is not type(other) or \
+                (self._valueDateNum, self._compoundFreq, self._ir_vol, self._mean_reversion) != \
+                (other._valueDateNum, other._compoundFreq, other._ir_vol, other._mean_reversion) or \
+                [d[2] for d in self._data] != [d[2] for d in other._data]:
+            return self._valueDateNum
+        for k in range(len(self._data)):
+            if self._data[k][1] != other._data[k][1]:
+                if k == 0:
+                    return self._valueDateNum
+                if interpolate:
+                    return self._data[k-1][2]
+                # the nearest point is k from the midpoint on
+                return (self._data[k-1][2] + self._data[k][2]) / 2
+        return float('inf')
+
+    def download_curve(self, cache: 'TreasuryCurveCache'=None) -> None:
+        ''' load the treasury par curve of the value date, the month is downloaded once into
+            the cache (DOWNLOAD_CACHE if None), see TreasuryCurveCache
+        '''
+        self._data = []
+        df = (cache or DOWNLOAD_CACHE).getMonth(self._valueDate)
         df_day = df[df['Date']==self._valueDate.strftime('%m/%d/%Y')]
+        if df_day.empty:
+            raise Exception(f"No data found for {self._valueDate}")
         df_day = df_day.reset_index(drop=True)
         for col in df_day.columns:
             if col == 'Date':
@@ -86,27 +131,484 @@ class Curve():
             out[0], out[1] = self._data[-1][0], self._data[-1][1]
         return self._data[-1][1]
 
+    def getRates(self, value_dates, interpolate=False) -> np.ndarray:
+        ''' Vectorized getTheRate by binary search of the curve dates
+            Params:
+              value_dates: array of date numbers
+            Return:
+              array of the rates, linearly interpolated or of the closest point as in getTheRate
+        '''
+        value_dates = np.asarray(value_dates, dtype=float)
+        if self._numRate <= 0:
+            return np.full(value_dates.shape, -1.0)
+        days = np.array([d[2] for d in self._data])
+        rates = np.array([d[1] for d in self._data])
+        # the first point on or after the date, as the scan of getTheRate
+        i = np.searchsorted(days, value_dates, side='left')
+        upper = np.minimum(i, self._numRate - 1)
+        lower = np.maximum(upper - 1, 0)
+        if interpolate:
+            period = days[upper] - days[lower]
+            w = np.divide(value_dates - days[lower], period, out=np.zeros(value_dates.shape), where=period > 0)
+            the_rates = rates[lower] + (rates[upper] - rates[lower]) * w
+        else:
+            nearest = np.where(value_dates - days[lower] < days[upper] - value_dates, lower, upper)
+            the_rates = rates[nearest]
+        # before the first and after the last point
+        the_rates = np.where(i == 0, rates[0], the_rates)
+        return np.where(i == self._numRate, rates[-1], the_rates)
+
+    def getDiscountFactors(self, value_dates, interpolate=False) -> np.ndarray:
+        ''' Return:
+              array of the discount factors from the value date to the date numbers, at the
+              continuously compounded getRates
+        '''
+        value_dates = np.asarray(value_dates, dtype=float)
+        rates = self.getRates(value_dates, interpolate)
+        t = (value_dates - self._valueDateNum) / 365.25
+        return np.exp(-self._compoundFreq * np.log1p(rates / self._compoundFreq) * t)
+
+    def getRateWeights(self, value_date: [date, float], interpolate=False) -> list:
+        ''' The curve points getTheRate uses for the given date and their weights,
+            the derivatives of the rate to the rates of the points
+            Return:
+              list of (index, weight) into get_curve_data()
+        '''
+        if self._numRate <= 0:
+            return []
+        if isinstance(value_date, date):
+            value_date = toDateNumber(value_date)
+
+        for i in range(self._numRate):
+            if value_date <= self._data[i][2]:
+                if i==0:
+                    return [(0, 1.0)]
+                if interpolate:
+                    w = (value_date - self._data[i-1][2]) / (self._data[i][2] - self._data[i-1][2])
+                    return [(i-1, 1.0 - w), (i, w)]
+                if (value_date - self._data[i-1][2] < self._data[i][2] -value_date):
+                    return [(i-1, 1.0)]
+                return [(i, 1.0)]
+        return [(self._numRate - 1, 1.0)]
+
     def load_from_csv(self, csv: str):
-        ''' load from csv file '''
-        self._data = []
+        ''' load from csv file, parsed once per file by CurveStore '''
+        self._data = list(CurveStore.from_csv(csv).getCurve(self._valueDate)._data)
+        self._numRate = len(self._data)
+
+
+class SvenssonCurve(Curve):
+    ''' Nelson-Siegel-Svensson curve, the rate at t years is
+          b0 + b1 * f(t / tau1) + b2 * (f(t / tau1) - exp(-t / tau1)) + b3 * (f(t / tau2) - exp(-t / tau2))
+        with f(x) = (1 - exp(-x)) / x, in the convention of the tabulated rates it is fitted to
+        (fit), so it can replace a Curve with the same interface. It only stores the six
+        parameters and evaluates the rates at any dates in closed form, smooth between the points.
+        Its points (get_curve_data) are the rates at whole years, evaluated on access, and
+        getRateWeights gives the derivatives of a rate to them at fixed tau, for key rates.
+    '''
+    YEARS = tuple(range(1, 31))  # tenors of the points
+    _numRate = len(YEARS)
+
+    def __init__(self, valueDate: date, params) -> None:
+        ''' Params:
+              params: b0, b1, b2, b3, tau1, tau2
+        '''
+        self._valueDate = valueDate
+        self._valueDateNum = toDateNumber(valueDate)
+        self._compoundFreq = 2  # semi
+        self._ir_vol = 0.2
+        self._mean_reversion = 0.05
+        self._params = np.asarray(params, dtype=float)
+        self._weights = None  # pinv of the basis of the points, on the first getRateWeights
+
+    def __str__(self) -> str:
+        return (f"{self._valueDate.strftime('%Y-%m-%d')}\tSvensson " +
+                " ".join(f"{p:.6g}" for p in self._params))
+
+    @property
+    def _data(self) -> list:
+        dates = [self._valueDate + relativedelta(years=year) for year in self.YEARS]
+        days = [toDateNumber(d) for d in dates]
+        return [(d, float(r), n) for d, r, n in zip(dates, self.getRates(days), days)]
+
+    def getParams(self) -> np.ndarray:
+        return self._params.copy()
+
+    @staticmethod
+    def _basis(t, tau1: float, tau2: float) -> np.ndarray:
+        ''' Return: the loadings of b0..b3 at the times t in years, one row per time '''
+        t = np.maximum(np.asarray(t, dtype=float), 1.0e-10)
+        x1, x2 = t / tau1, t / tau2
+        f1, f2 = -np.expm1(-x1) / x1, -np.expm1(-x2) / x2
+        return np.stack([np.ones(t.shape), f1, f1 - np.exp(-x1), f2 - np.exp(-x2)], axis=-1)
+
+    def _times(self, value_dates) -> np.ndarray:
+        return (np.asarray(value_dates, dtype=float) - self._valueDateNum) / 365.25
+
+    def cache_key(self) -> tuple:
+        return (self._valueDateNum, self._compoundFreq, self._ir_vol, self._mean_reversion,
+                ('Svensson',) + tuple(self._params))
+
+    def getChangeDate(self, other: Curve, interpolate=False) -> float:
+        if type(self) is not type(other) or self.cache_key() != other.cache_key():
+            return self._valueDateNum
+        return float('inf')
+
+    def getTheRate(self, value_date: [date, float], interpolate=False, out=None):
+        ''' the rate at the date, interpolate is ignored '''
+        if isinstance(value_date, date):
+            value_date = toDateNumber(value_date)
+        rate = float(self.getRates([value_date])[0])
+        if out:
+            out[0], out[1] = value_date, rate
+        return rate
+
+    def getRates(self, value_dates, interpolate=False) -> np.ndarray:
+        ''' Return: array of the rates at the date numbers, interpolate is ignored '''
+        return self._basis(self._times(value_dates), *self._params[4:]) @ self._params[:4]
+
+    def getRateWeights(self, value_date: [date, float], interpolate=False) -> list:
+        ''' The derivatives of the rate at the date to the rates of the points, at fixed tau
+            Return:
+              list of (index, weight) into get_curve_data()
+        '''
+        if isinstance(value_date, date):
+            value_date = toDateNumber(value_date)
+        tau1, tau2 = self._params[4:]
+        if self._weights is None:
+            days = [toDateNumber(self._valueDate + relativedelta(years=year)) for year in self.YEARS]
+            self._weights = np.linalg.pinv(self._basis(self._times(days), tau1, tau2))
+        w = self._basis(self._times([value_date]), tau1, tau2)[0] @ self._weights
+        return list(enumerate(w))
+
+    @classmethod
+    def fitParams(cls, valueDate: date, rate_dates: list, rates) -> np.ndarray:
+        ''' Least squares fit to the rates of the points, the betas are linear given tau, which
+            is searched on a grid and refined by Nelder-Mead. Missing (nan) rates are left out,
+            with less than 6 points b3 is 0 (Nelson-Siegel).
+            Params:
+              rate_dates: dates of the points
+              rates: rates of the points
+            Return:
+              array of b0, b1, b2, b3, tau1, tau2
+        '''
+        points = [(toDateNumber(d), float(r)) for d, r in zip(rate_dates, rates) if np.isfinite(r)]
+        if len(points) < 4:
+            raise ValueError(f"Svensson fit needs at least 4 points, {len(points)} given")
+        t = (np.array([p[0] for p in points]) - toDateNumber(valueDate)) / 365.25
+        y = np.array([p[1] for p in points])
+        k = 4 if len(points) >= 6 else 3
+
+        def solve(tau1, tau2):
+            basis = cls._basis(t, tau1, tau2)[:, :k]
+            beta = np.linalg.lstsq(basis, y, rcond=None)[0]
+            r = basis @ beta - y
+            return float(r @ r), beta
+
+        grid = np.exp(np.linspace(math.log(0.1), math.log(30.0), 13))
+        best = min(((solve(t1, t2)[0], t1, t2) for t1 in grid for t2 in grid if t2 > t1 or k == 3),
+                   key=lambda x: x[0])
+        res = minimize(lambda p: solve(*np.exp(p))[0], np.log(best[1:]), method='Nelder-Mead',
+                       options={'xatol': 1.0e-6, 'fatol': 1.0e-14})
+        tau1, tau2 = np.exp(res.x) if res.fun <= best[0] else best[1:]
+        if k == 3:
+            tau2 = tau1
+        _, beta = solve(tau1, tau2)
+        return np.concatenate([beta, np.zeros(4 - k), [tau1, tau2]])
+
+    @classmethod
+    def fit(cls, valueDate: date, rate_dates: list, rates) -> 'SvenssonCurve':
+        ''' Return: the curve of fitParams '''
+        return cls(valueDate, cls.fitParams(valueDate, rate_dates, rates))
+
+    def toCurve(self, years=YEARS) -> Curve:
+        ''' Return: a Curve of the rates at whole years '''
+        curve = Curve(self._valueDate)
+        for year in years:
+            rate_date = self._valueDate + relativedelta(years=year)
+            curve.append_data(self.getTheRate(rate_date), rate_date)
+        curve._numRate = len(curve._data)
+        curve._compoundFreq, curve._ir_vol, curve._mean_reversion = self._compoundFreq, self._ir_vol, self._mean_reversion
+        return curve
+
+
+class CurveStore():
+    ''' The curves of a csv file with one row per date, parsed once into a sorted array of the
+        dates and an array of the rates with one column per tenor. getCurve finds the row by
+        binary search and builds the Curve of a date once, later calls return the same Curve,
+        which is shared and should not be modified (shocks copy it, see Scenario.shockCurve).
+        A store can be saved to a binary archive (save_archive), which from_csv and
+        Curve.load_from_csv read in place of the csv with numpy.memmap, so the processes that
+        open it share the pages of the OS cache and only the rows they use are read.
+    '''
+    # archive layout: MAGIC, header length (uint64), json header, the dates (float64, sorted)
+    # at days_offset and the rates (float64, one row per date) at rates_offset
+    MAGIC = b'CURVEARC'
+    ALIGN = 64
+    _stores = {}  # path: ((modification time, inode), CurveStore)
+    _lock = threading.Lock()
+
+    def __init__(self, columns: list, days, rates, source: str=None) -> None:
+        ''' Params:
+              columns: the names of the rate columns, as in the csv header
+              days: sorted date numbers of the rows
+              rates: the rates of the rows in decimal, one column per tenor
+        '''
+        self._source = source
+        self._columns = list(columns)
+        self._tenors = [self._parse_tenor(col) for col in self._columns]  # relativedelta of every column
+        self._days = days
+        self._rates = rates
+        self._curves = {}
+        self._svensson = {}  # value date: Svensson parameters, fitted on request
+        self._curveLock = threading.Lock()
+
+    @staticmethod
+    def _parse_tenor(col: str):
+        if 'Mo' in col:
+            return relativedelta(months=int(col.split(' ')[0]))
+        if 'Yr' in col:
+            return relativedelta(years=int(col.split(' ')[0]))
+        if 'SVEN' in col:
+            return relativedelta(years=int(col[-2:]))
+        return None
+
+    @classmethod
+    def read_csv(cls, csv: str) -> 'CurveStore':
         df = pd.read_csv(csv)
         if df.empty:
             raise Exception(f"Failed to load curve from file {csv}")
-        df['Date'] = pd.to_datetime(df['Date'])
-        df['Date'] = df['Date'].dt.date
-        df = df[df['Date']==self._valueDate]
-        if df.empty:
-            raise Exception(f"No data found for {self._valueDate}")
-        df = df.reset_index(drop=True)
-        for col in df.columns:
-            if col == 'Date':
-                continue
-            if 'Mo' in col:
-                _date = self._valueDate + relativedelta(months=int(col.split(' ')[0]))
-            elif 'Yr' in col:
-                _date = self._valueDate + relativedelta(years=int(col.split(' ')[0]))
-            elif 'SVEN' in col:
-                _date = self._valueDate + relativedelta(years=int(col[-2:]))
-            _rate = float(df.loc[0, col]) / 100
-            self.append_data(_rate, _date)
-        self._numRate = len(self._data)
+        columns = [col for col in df.columns if col != 'Date' and cls._parse_tenor(col) is not None]
+        days = np.array([toDateNumber(d) for d in pd.to_datetime(df['Date']).dt.date])
+        # stable, so the first row of a date is found as in a filter of the file
+        order = np.argsort(days, kind='stable')
+        return cls(columns, days[order], df[columns].to_numpy(dtype=float)[order] / 100, csv)
+
+    @classmethod
+    def read_archive(cls, path: str) -> 'CurveStore':
+        ''' Open an archive of save_archive, the arrays are memory mapped read only '''
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise Exception(f"{path} is not a curve archive")
+            size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(size).decode('utf-8'))
+        n, m = header['num_dates'], len(header['columns'])
+        days = np.memmap(path, dtype='<f8', mode='r', offset=header['days_offset'], shape=(n,)) if n else np.empty(0)
+        rates = np.memmap(path, dtype='<f8', mode='r', offset=header['rates_offset'], shape=(n, m)) if n else np.empty((0, m))
+        return cls(header['columns'], days, rates, path)
+
+    @classmethod
+    def is_archive(cls, path: str) -> bool:
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def save_archive(self, path: str) -> None:
+        ''' Write the store to a binary archive, see read_archive '''
+        n = len(self._days)
+        header = {'columns': self._columns, 'num_dates': n, 'days_offset': 0, 'rates_offset': 0}
+        # the offsets are part of the header, so size it with room for their digits
+        size = len(json.dumps(header).encode('utf-8')) + 64
+        days_offset = -(-(len(self.MAGIC) + 8 + size) // self.ALIGN) * self.ALIGN
+        header['days_offset'] = days_offset
+        header['rates_offset'] = -(-(days_offset + 8 * n) // self.ALIGN) * self.ALIGN
+        encoded = json.dumps(header).encode('utf-8').ljust(size)
+        # written next to the archive and renamed over it, readers keep the pages of the old file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self.MAGIC)
+                f.write(np.array([size], dtype='<u8').tobytes())
+                f.write(encoded)
+                f.seek(days_offset)
+                f.write(np.ascontiguousarray(self._days, dtype='<f8').tobytes())
+                f.seek(header['rates_offset'])
+                f.write(np.ascontiguousarray(self._rates, dtype='<f8').tobytes())
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def convert(cls, csv: str, path: str) -> 'CurveStore':
+        ''' Convert a curve csv file to an archive
+            Return:
+              the store of the archive
+        '''
+        cls.read_csv(csv).save_archive(path)
+        return cls.from_csv(path)
+
+    @classmethod
+    def from_csv(cls, csv: str) -> 'CurveStore':
+        ''' Return:
+              the store of the file, a csv or an archive, read on the first call and again if
+              the file changed
+        '''
+        path = os.path.abspath(csv)
+        stat = os.stat(path)
+        # a replaced archive is a new file, even within the resolution of the modification time
+        mtime = (stat.st_mtime_ns, stat.st_ino)
+        with cls._lock:
+            entry = cls._stores.get(path)
+            if entry is None or entry[0] != mtime:
+                store = cls.read_archive(path) if cls.is_archive(path) else cls.read_csv(csv)
+                entry = cls._stores[path] = (mtime, store)
+            return entry[1]
+
+    def getDates(self) -> list:
+        return [date.fromordinal(int(d) + ORDINAL_OFFSET) for d in self._days]
+
+    def getCurve(self, value_date: date) -> Curve:
+        ''' Return:
+              the Curve of value_date, raises if the file has no row for the date
+        '''
+        curve = self._curves.get(value_date)
+        if curve is not None:
+            return curve
+        day = toDateNumber(value_date)
+        k = int(np.searchsorted(self._days, day))
+        if k == len(self._days) or self._days[k] != day:
+            raise Exception(f"No data found for {value_date}")
+        curve = Curve(value_date)
+        for tenor, rate in zip(self._tenors, self._rates[k]):
+            curve.append_data(float(rate), value_date + tenor)
+        curve._numRate = len(curve._data)
+        with self._curveLock:
+            return self._curves.setdefault(value_date, curve)
+
+    def getSvensson(self, value_date: date) -> np.ndarray:
+        ''' Return:
+              the Svensson parameters (b0..b3, tau1, tau2) of the points of value_date, fitted once
+        '''
+        params = self._svensson.get(value_date)
+        if params is not None:
+            return params
+        day = toDateNumber(value_date)
+        k = int(np.searchsorted(self._days, day))
+        if k == len(self._days) or self._days[k] != day:
+            raise Exception(f"No data found for {value_date}")
+        params = SvenssonCurve.fitParams(value_date, [value_date + tenor for tenor in self._tenors], self._rates[k])
+        params.setflags(write=False)
+        with self._curveLock:
+            return self._svensson.setdefault(value_date, params)
+
+    def getSvenssonCurve(self, value_date: date) -> SvenssonCurve:
+        ''' Return:
+              a SvenssonCurve of the parameters of value_date, see getSvensson
+        '''
+        return SvenssonCurve(value_date, self.getSvensson(value_date))
+
+    def fitSvensson(self, start: date=None, end: date=None) -> tuple:
+        ''' Fit the Svensson parameters of every date from start to end, e.g. to keep a history
+            as six numbers per date instead of the points
+            Return:
+              tuple of the list of the dates and the array of the parameters, one row per date
+              (nan if the date cannot be fitted)
+        '''
+        dates = [d for d in self.getDates() if (start is None or d >= start) and (end is None or d <= end)]
+        params = np.full((len(dates), 6), np.nan)
+        for row, value_date in enumerate(dates):
+            try:
+                params[row] = self.getSvensson(value_date)
+            except ValueError:
+                pass
+        return dates, params
+
+
+def _fetch_url(url: str) -> str:
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return response.read().decode('utf-8')
+
+
+class TreasuryCurveCache():
+    ''' Month keyed cache of the daily treasury par curve csv files of treasury.gov on disk.
+        A month is downloaded once into cache_dir/YYYYMM.csv. The current and future months
+        are downloaded again when older than ttl seconds (never if ttl is None). The file of a
+        past month is final if it was written after the month ended and is then only downloaded
+        again on refresh, a file written during the month is downloaded again. Offline, only the cache is read and a
+        missing month raises.
+        Params:
+          cache_dir: directory of the files, $CURVE_CACHE_DIR or ~/.cache/treasury_curves if None
+          ttl: seconds a file of an incomplete month is used for
+          offline: never download, $CURVE_OFFLINE=1 if None
+          fetcher: function of the url returning the csv text, e.g. a stand-in for tests
+          url: template of the url with {yearmonth}
+    '''
+    URL = ("https://home.treasury.gov/resource-center/data-chart-center/interest-rates/daily-treasury-rates.csv"
+           "/all/{yearmonth}?type=daily_treasury_yield_curve&field_tdr_date_value_month={yearmonth}&page&_format=csv")
+
+    def __init__(self, cache_dir: str=None, ttl: float=86400.0, offline: bool=None, fetcher=None,
+                 url: str=None) -> None:
+        self._cache_dir = cache_dir or os.environ.get('CURVE_CACHE_DIR') or \
+            os.path.join(os.path.expanduser('~'), '.cache', 'treasury_curves')
+        self._ttl = ttl
+        self._offline = os.environ.get('CURVE_OFFLINE') == '1' if offline is None else offline
+        self._fetcher = fetcher or _fetch_url
+        self._url = url or self.URL
+        self._months = {}  # yearmonth: (modification time, DataFrame)
+        self._lock = threading.Lock()
+        self.downloads = 0
+
+    def getPath(self, yearmonth: str) -> str:
+        return os.path.join(self._cache_dir, f"{yearmonth}.csv")
+
+    def _isFresh(self, yearmonth: str, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        mtime = os.path.getmtime(path)
+        if yearmonth < date.today().strftime('%Y%m'):
+            # final only if written after the month ended, a file of a month in progress is partial
+            month_end = datetime(int(yearmonth[:4]), int(yearmonth[4:]), 1) + relativedelta(months=1)
+            return mtime >= month_end.timestamp()
+        return self._ttl is None or time.time() - mtime < self._ttl
+
+    def _download(self, yearmonth: str) -> None:
+        text = self._fetcher(self._url.format(yearmonth=yearmonth))
+        pd.read_csv(io.StringIO(text))  # raises on a broken download, before it replaces the file
+        os.makedirs(self._cache_dir, exist_ok=True)
+        path = self.getPath(yearmonth)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        self.downloads += 1
+
+    def getMonth(self, month: [date, str], refresh: bool=False) -> pd.DataFrame:
+        ''' Return:
+              DataFrame of the csv of the month (a date in it or YYYYMM), from the cache
+              if it is fresh, downloaded otherwise, see the class
+        '''
+        yearmonth = month.strftime('%Y%m') if isinstance(month, date) else month
+        path = self.getPath(yearmonth)
+        with self._lock:
+            if self._offline:
+                if refresh or not os.path.exists(path):
+                    raise Exception(f"Curve of {yearmonth} is not in the cache {self._cache_dir} (offline)")
+            elif refresh or not self._isFresh(yearmonth, path):
+                self._download(yearmonth)
+            mtime = os.path.getmtime(path)
+            entry = self._months.get(yearmonth)
+            if entry is None or entry[0] != mtime:
+                entry = self._months[yearmonth] = (mtime, pd.read_csv(path))
+            return entry[1]
+
+    def prefetch(self, start: date, end: date, refresh: bool=False) -> list:
+        ''' Download the months from start to end that are not fresh in the cache
+            Return:
+              list of the months (YYYYMM) that were downloaded
+        '''
+        downloaded = []
+        month = date(start.year, start.month, 1)
+        while month <= end:
+            yearmonth = month.strftime('%Y%m')
+            with self._lock:
+                if refresh or not self._isFresh(yearmonth, self.getPath(yearmonth)):
+                    if self._offline:
+                        raise Exception(f"Cannot download the curve of {yearmonth} (offline)")
+                    self._download(yearmonth)
+                    downloaded.append(yearmonth)
+            month += relativedelta(months=1)
+        return downloaded
+
+
+# the cache of Curve.download_curve
+DOWNLOAD_CACHE = TreasuryCurveCache()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+import math
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from curve import Curve
+from oas import OASModel, calibratedTree
+import utilities
+
+
+class MCModel(OASModel):
+    ''' Monte Carlo alternative to the trinomial tree with the same interface and schedules, for
+        validation of tree prices. The rate on a path is m(t) * exp(x), x follows
+        dx = -a x dt + vol dW as the levels of the tree and is sampled exactly at the time steps.
+        m(t) is calibrated to the curve on its own set of paths, the call is exercised by
+        Longstaff-Schwartz regression on another set, and the price is the mean over the pricing
+        paths, generated and valued in chunks. Every set is reproducible from _seed.
+    '''
+    def __init__(self) -> None:
+        super().__init__()
+        self._yearly_time_step = 24
+        self._use_closed_form = False  # discount the cash flows on the paths
+        self._num_paths = 50000  # pricing paths
+        self._chunk_size = 5000  # paths valued at a time, bounds the memory
+        self._num_calibration_paths = 50000
+        self._num_regression_paths = 10000
+        self._basis_degree = 3  # polynomial in x of the continuation value
+        self._seed = 0
+        self._max_workers = 1  # processes for the pricing chunks
+        self._executor = None  # pool of the current Calculate_* call, see _pool
+        self._multipliers = None
+        self._coefficients = None
+        self._standardError = .0
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_executor'] = None
+        return state
+
+    @contextmanager
+    def _pool(self):
+        ''' The process pool for the pricing chunks, started once for all the sweeps of a
+            Calculate_* call (the pool of an enclosing call is reused), None for one worker
+        '''
+        if self._max_workers <= 1 or self._executor is not None:
+            yield self._executor
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+        try:
+            yield self._executor
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+
+    def Calculate_OAS(self, *args, **kwargs):
+        with self._pool():
+            return super().Calculate_OAS(*args, **kwargs)
+
+    def Calculate_Price(self, *args, **kwargs):
+        with self._pool():
+            return super().Calculate_Price(*args, **kwargs)
+
+    def Calculate_Risk(self, *args, **kwargs):
+        with self._pool():
+            return super().Calculate_Risk(*args, **kwargs)
+
+    def _settings_key(self) -> tuple:
+        return super()._settings_key() + (self._num_paths, self._chunk_size, self._num_calibration_paths,
+                                          self._num_regression_paths, self._basis_degree, self._seed)
+
+    def _set_rate_tree(self):
+        ''' Calibrate m(t) by forward induction on the calibration paths: at every step m solves
+            mean(deflator * exp(-m * exp(x) * dT)) = curve discount factor, as in calibratedTree.extend
+            Return:
+              0 on success, -1 otherwise
+        '''
+        if self._numT < 0:
+            return -1
+        self._calibratedTree = None
+        rng = np.random.default_rng(np.random.SeedSequence(self._seed, spawn_key=(0,)))
+        n = self._num_calibration_paths // 2 * 2
+        decay, std = _ou_step(self._a, self._vol, self._dT)
+        today = utilities.toDateNumber(self._curve._valueDate)
+
+        solve = calibratedTree._solve_multiplier
+        if self._stats is not None:
+            solve = self._stats.timed('_solve_multiplier', solve)
+        x = np.zeros(n)
+        deflator = np.full(n, 1.0 / n)
+        multipliers = np.zeros(self._numT + 1)
+        multiplier = 0
+        dFs = self._curve.getDiscountFactors(today + np.arange(1, self._numT + 2) * self._dT * 365.25)
+        for i in range(self._numT + 1):
+            dF = dFs[i]
+            bdT = np.exp(x) * self._dT
+            multiplier = solve(deflator, bdT, dF, multiplier)
+            if multiplier < 0:
+                print("cannot find multiplier")
+                return -1
+            multipliers[i] = multiplier
+            deflator = deflator * np.exp(-multiplier * bdT)
+            x = x * decay + std * _antithetic(rng, n)
+        self._multipliers = multipliers
+        return 0
+
+    def _schedule(self) -> dict:
+        ''' the inputs of a chunk, everything but the paths '''
+        return {'numT': self._numT, 'dT': self._dT, 'a': self._a, 'vol': self._vol,
+                'multipliers': self._multipliers, 'credit_spread': self._credit_spread,
+                'cpn': np.array(self._cpnSchedule), 'call': np.array(self._callPrice),
+                'callPay': np.array(self._callPrice) + np.array(self._AISchedule),
+                'redemption': self._bond.Redemption, 'degree': self._basis_degree,
+                'seed': self._seed}
+
+    def _calculate_values(self):
+        ''' Fit the exercise regression on the regression paths at the credit spread, then
+            value the pricing paths chunk by chunk with it (on _max_workers processes).
+            Return:
+              0 on success, -1 otherwise
+        '''
+        if self._numT < 0 or self._multipliers is None:
+            return -1
+        schedule = self._schedule()
+        _, _, _, schedule['coefficients'] = _value_chunk(schedule, (1,), self._num_regression_paths)
+
+        sizes = [self._chunk_size] * (self._num_paths // self._chunk_size)
+        if self._num_paths % self._chunk_size:
+            sizes.append(self._num_paths % self._chunk_size)
+        tasks = [(schedule, (2, k), size) for k, size in enumerate(sizes)]
+        with self._pool() as executor:
+            if executor is not None and len(tasks) > 1:
+                results = list(executor.map(_value_chunk_task, tasks))
+            else:
+                results = [_value_chunk_task(task) for task in tasks]
+
+        pairs = np.concatenate([r[0] for r in results])
+        self.priceNode = float(pairs.mean())
+        self._spreadRho = sum(r[1] for r in results) / sum(r[2] for r in results)
+        self._standardError = float(pairs.std() / math.sqrt(pairs.size))
+        self._coefficients = schedule['coefficients']
+        return 0
+
+    def get_standard_error(self):
+        ''' Return: standard error of the dirty price of the last valuation, over antithetic pairs '''
+        return self._standardError
+
+    def _calculate_curve_sensitivities(self):
+        return None
+
+    def Calculate_Prices(self, bonds: list, curve: Curve, value_date, credit_spreads) -> list:
+        raise ValueError("Stacked valuation needs the trinomial tree")
+
+
+def _ou_step(a: float, vol: float, dt: float) -> tuple:
+    ''' Return: the decay and the standard deviation of the exact step of x over dt '''
+    return math.exp(-a * dt), vol * math.sqrt(-math.expm1(-2.0 * a * dt) / (2.0 * a))
+
+
+def _antithetic(rng, n: int):
+    z = rng.standard_normal(n // 2)
+    return np.concatenate([z, -z])
+
+
+def _simulate(schedule: dict, spawn_key: tuple, n: int):
+    ''' Return: x of n paths (antithetic pairs) at the steps 0..numT, one row per step '''
+    rng = np.random.default_rng(np.random.SeedSequence(schedule['seed'], spawn_key=spawn_key))
+    decay, std = _ou_step(schedule['a'], schedule['vol'], schedule['dT'])
+    x = np.zeros((schedule['numT'] + 1, n))
+    for i in range(schedule['numT']):
+        x[i+1] = x[i] * decay + std * _antithetic(rng, n)
+    return x
+
+
+def _value_chunk(schedule: dict, spawn_key: tuple, n: int) -> tuple:
+    ''' Roll the cash flows back along n paths. At a call step the issuer calls where the
+        regression of the value on a polynomial in x is at least the call price, as on the tree.
+        Without coefficients in the schedule they are fitted on these paths (Longstaff-Schwartz).
+        Return:
+          tuple of the dirty price of every antithetic pair, the sum of the spread derivatives,
+          the number of paths and the regression coefficients of every step
+        '''
+    n = max(n // 2 * 2, 2)
+    x = _simulate(schedule, spawn_key, n)
+    numT, dT, s = schedule['numT'], schedule['dT'], schedule['credit_spread']
+    cpn, call, callPay = schedule['cpn'], schedule['call'], schedule['callPay']
+    fitted = schedule.get('coefficients')
+    coefficients = [None] * (numT + 1)
+
+    values = np.full(n, schedule['redemption'] + cpn[numT])
+    if values[0] >= call[numT]:
+        values = np.full(n, min(values[0], callPay[numT]))
+    rhos = np.zeros(n)
+    for i in reversed(range(numT)):
+        # the spread is added to the semi-annual compounded rate, see calibratedTree.getDiscountFactors
+        with np.errstate(over='ignore'):
+            growth = np.exp(schedule['multipliers'][i] * np.exp(x[i]) / 2.0) + s / 2.0
+        discount = np.power(growth, -2.0 * dT)
+        rhos = rhos * discount - values * dT * discount / growth
+        values = values * discount + cpn[i]
+
+        if call[i] < 1.0e+49:
+            basis = np.vander(x[i], schedule['degree'] + 1)
+            if fitted is None:
+                coefficients[i] = np.linalg.lstsq(basis, values, rcond=None)[0]
+            estimate = basis @ (coefficients[i] if fitted is None else fitted[i])
+            called = (estimate >= call[i]) & (estimate > callPay[i])
+            values = np.where(called, callPay[i], values)
+            rhos = np.where(called, 0.0, rhos)
+
+    pairs = 0.5 * (values[:n//2] + values[n//2:])
+    return pairs, rhos.sum(), n, coefficients
+
+
+def _value_chunk_task(task: tuple) -> tuple:
+    pairs, rho, n, _ = _value_chunk(*task)
+    return pairs, rho, n
@@ -1,6 +1,10 @@
 from __future__ import annotations
 import math
 import copy
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
 from bond import Bond
 from curve import Curve
 from datetime import date, datetime
@@ -22,8 +26,40 @@ class OASModel():
         self._u = 0
         self._d = 0
         self._credit_spread = 0
+        self._price_tolerance = 0.01  # clean price tolerance of the OAS solver
+        self._spread_tolerance = 1.0e-10
+        self._max_iterations = 50
+        self._target_price = .0
+        self._num_sweeps = 0  # backward sweeps of the last OAS solve
+        self._spreadRho = .0
+        self._oas = None  # credit spread solved by the last Calculate_OAS
+        self._profile = False  # record the time of every phase of Calculate_OAS, see get_stats()
+        self._stats = None
+        self._use_closed_form = True  # value option-free bonds by discounting the cash flows off the curve
+        self._closed_form = False  # the current bond is valued in closed form
+        self._cashFlows = None
+        self._cashFlowTimes = None
+        self._cashFlowRates = None
+
+        # precision mode, OAS on Richardson extrapolated prices over halving time grid steps
+        self._price_precision = None  # error tolerance of the clean price, None for a single tree
+        self._precision_grid = None  # coarsest grid, _time_grid or timeGrid(0.04, 0.5, 0.04, 0.04) if None
+        self._precision_max_levels = 6
+        self._levels = []  # models of the grids in use
+        self._level_prices = []
+        self._extrapolation_error = .0
+        self._precision_report = None
+
         self._p = nodeProbability()
         self._rateTree = None
+        self._use_tree_cache = True
+        self._calibratedTree = None
+        self._prune_threshold = 0  # Q mass dropped from each tail of a time step, 0 to keep all nodes
+        self._prunedTree = None
+        self._time_grid = None  # timeGrid for a non-uniform tree, None for the uniform tree
+        self._gridTree = None
+        self._times = None  # time of every step in years from the value date
+        self._stepDays = None  # and in days
 
         self._numCoupon = 0 # num of future coupons
         self._couponDates = None
@@ -45,7 +81,16 @@ class OASModel():
     def _set_tree_params(self):
         self._dT = 1.0 / self._yearly_time_step
         self._num_yrs = (utilities.toDateNumber(self._bond.Maturity) - utilities.toDateNumber(self._valueDate)) / 365.25
-        self._numT = int(self._num_yrs / self._dT + 0.1)
+        if self._time_grid:
+            self._times = self._time_grid.build(self._bond, self._valueDate)
+            self._numT = len(self._times) - 1
+            # days from the value date, the grid dates are whole days
+            days = self._times * 365.25
+            self._stepDays = np.where(np.fabs(days - np.rint(days)) < 1.0e-6, np.rint(days), days)
+        else:
+            self._numT = int(self._num_yrs / self._dT + 0.1)
+            self._times = np.arange(max(self._numT + 1, 0)) * self._dT
+            self._stepDays = self._times * 365.25
         self._vol = self._curve._ir_vol
         self._a = self._curve._mean_reversion
         self._j_max = int(0.184 * self._yearly_time_step / self._a ) # / 4)
@@ -54,7 +99,57 @@ class OASModel():
         self._p.setJmax(self._j_max)
         self._p.setNodeProbability(self._dT, self._a)
 
+    def _get_calibrated_tree(self, numT: int) -> calibratedTree:
+        ''' Return:
+              the tree calibrated to the curve with at least numT steps, None if the calibration fails
+        '''
+        if self._use_tree_cache:
+            return TREE_CACHE.getTree(self._curve, self._yearly_time_step, numT, self._stats)
+        calibrated = calibratedTree(self._curve, self._yearly_time_step)
+        if calibrated.extend(numT, self._stats) == -1:
+            return None
+        return calibrated
+
     def _set_rate_tree(self):
+        ''' Set the rate tree up to _numT from a calibrated tree, shared through the tree cache
+            between all models on the same curve and tree parameters. The calibrated rates are
+            not changed, the credit spread is applied to the discount factors of every sweep.
+            Return:
+              0 on success, -1 otherwise
+        '''
+        if self._numT < 0:
+            return -1
+        if self._time_grid:
+            self._gridTree = gridTree(self._curve, self._times)
+            return self._gridTree.extend(self._numT, self._stats)
+
+        calibrated = self._get_calibrated_tree(self._numT)
+        if calibrated is None:
+            return -1
+
+        self._calibratedTree = calibrated
+        self._prunedTree = None
+        return 0
+
+    def _get_sweep_tree(self):
+        ''' Return:
+              the tree of the backward sweep, the grid tree, the pruned view of the calibrated
+              tree or the calibrated tree, None if there is none
+        '''
+        if self._time_grid:
+            return self._gridTree
+        if self._j_max <= 0:
+            return None
+        if self._prune_threshold > 0:
+            if self._prunedTree is None or self._prunedTree.getThreshold() != self._prune_threshold:
+                self._prunedTree = prunedTree(self._calibratedTree, self._prune_threshold, self._numT)
+            return self._prunedTree
+        return self._calibratedTree
+
+    def _set_rate_tree_loop(self):
+        ''' Node by node calibration into _rateTree, kept as the reference implementation for
+            _set_rate_tree, together with _set_credit_spread_to_rate_tree and _calculate_values_loop.
+        '''
         if self._numT < 0:
             return
         self._rateTree = []
@@ -92,6 +187,7 @@ class OASModel():
         self._credit_spread = credit_spread
 
     def _set_credit_spread_to_rate_tree(self):
+        ''' add the credit spread to the rates of _rateTree for _calculate_values_loop '''
         for i in range(self._numT+1):
             self._rateTree[i].adjustRatesByCreditSpread(self._credit_spread)
 
@@ -122,6 +218,9 @@ class OASModel():
         self._accruedInterest = self._bond.FaceValue * self._bond._coupon_schedule[idx-1].couponRate * utilities.calcYearFrac(self._bond._coupon_schedule[idx-1].couponDate, self._valueDate, self._bond.DayCount)
 
     def _set_cpn_schedule(self):
+        if self._time_grid:
+            self._set_grid_cpn_schedule()
+            return
         self._cpnSchedule = [0.0] * (self._numT + 1)
         begin, end = -2, -2
         for i in range(self._numCoupon):
@@ -133,7 +232,7 @@ class OASModel():
             end = int( (utilities.toDateNumber(self._couponDates[i]) - utilities.toDateNumber(self._valueDate)) / 365.25 / self._dT + 0.000001)
             begin = max(begin, 0)
             end = max(begin, end)
-            end = min(end, self._numCoupon - 1)
+            end = min(end, self._numT)
             j = begin
             while j <= end:
                 self._cpnSchedule[j] = self._couponAmounts[i]
@@ -142,12 +241,23 @@ class OASModel():
             if end == self._numT:
                 break
 
+    def _set_grid_cpn_schedule(self):
+        ''' the coupon dates are nodes of the time grid, pay every coupon at its own node '''
+        self._cpnSchedule = [0.0] * (self._numT + 1)
+        steps = {day: i for i, day in enumerate(self._stepDays)}
+        for i in range(self._numCoupon):
+            if self._couponDates[i] < self._valueDate:
+                continue
+            j = steps.get(utilities.toDateNumber(self._couponDates[i]) - utilities.toDateNumber(self._valueDate))
+            if j is not None:
+                self._cpnSchedule[j] += self._couponAmounts[i]
+
     def _set_ai_schedule(self):
         self._AISchedule = [0.0] * (self._numT + 1)
         nextDateIdx = self._bond._get_next_date_idx(self._valueDate)
 
         for i in range(self._numT):
-            t = i * self._dT * 365.25 + utilities.toDateNumber(self._valueDate)
+            t = self._stepDays[i] + utilities.toDateNumber(self._valueDate)
 
             while nextDateIdx <= self._bond._numCoupon and t > utilities.toDateNumber(self._bond._coupon_schedule[nextDateIdx].couponDate):
                 nextDateIdx += 1
@@ -162,15 +272,97 @@ class OASModel():
         if not self._bond.NextCallDate:
             return
         for i in range(self._numT):
-            t = i * self._dT * 365.25 + utilities.toDateNumber(self._valueDate)
+            t = self._stepDays[i] + utilities.toDateNumber(self._valueDate)
             if t >= utilities.toDateNumber(self._bond.NextCallDate):
                 self._callPrice[i] = self._bond.NextCallPrice
 
-    def _add_shift_to_rate_tree(self, shift: float):
+    def _calculate_values(self):
+        ''' Backward induction over the tree of _get_sweep_tree.
+            Return:
+              0 on success, -1 otherwise
+        '''
+        if self._numT < 0:
+            return -1
+        tree = self._get_sweep_tree()
+        if tree is None:
+            return -1
+        self._sweep(tree)
+        return 0
+
+    def _sweep(self, tree: calibratedTree, expectations: list=None, kept: list=None):
+        ''' Backward induction with one node vector per time step through the expect and
+            getDiscountFactors of the tree, so the uniform, pruned, grid and PDE trees share the
+            payoff and call logic. The derivative of the dirty price to the credit spread is
+            carried along in the same expectation as the values.
+            Params:
+              expectations, kept: lists of _numT to keep the expected values and the nodes where
+                the call does not bind at every step, for the adjoint sweep, None to not keep them
+        '''
+        # the values and their derivatives to the credit spread, stacked to take one expectation
+        state = np.zeros((2, tree.getWidth(self._numT)))
+        state[0] = self._bond.Redemption + self._cpnSchedule[self._numT]
+        callPay = self._callPrice[self._numT] + self._AISchedule[self._numT]
+        state[0] = np.where(state[0] >= self._callPrice[self._numT], np.minimum(state[0], callPay), state[0])
+
+        # go backwards from _numT - 1 to 0
+        for i in reversed(range(self._numT)):
+            discount, rho = tree.getDiscountFactors(i, tree.getDt(i), self._credit_spread)
+            expected = tree.expect(i, state)
+            state = expected * discount
+            state[0] += self._cpnSchedule[i]
+            state[1] += expected[0] * rho
+
+            callPay = self._callPrice[i] + self._AISchedule[i]
+            called = (state[0] >= self._callPrice[i]) & (state[0] > callPay)
+            if called.any():
+                state[0, called] = callPay
+                state[1, called] = 0.0
+            if expectations is not None:
+                expectations[i] = expected[0]
+                kept[i] = ~called
+
+        # Q at step 0 is one at the root
+        root = tree.getQ(0)
+        self.priceNode = float(np.dot(root, state[0]))
+        self._spreadRho = float(np.dot(root, state[1]))
+
+    def get_pruning_report(self) -> dict:
+        ''' Compare the pruned tree with the full tree at the current credit spread.
+            Return:
+              dict with the node counts, the largest Q mass dropped at a step and
+              the clean price error of the pruned tree
+        '''
+        windows = self._calibratedTree.getWindows(self._prune_threshold, self._numT)
+        nodes = sum(2 * min(i, self._j_max) + 1 for i in range(self._numT+1))
+        kept = sum(hi - lo + 1 for lo, hi in windows[:self._numT+1])
+        dropped = .0
         for i in range(self._numT+1):
-            self._rateTree[i].adjustRatesByCreditSpread(shift)
+            q = self._calibratedTree.getQ(i)
+            lo, hi = windows[i]
+            size = min(i, self._j_max)
+            dropped = max(dropped, float(1.0 - q[lo+size:hi+size+1].sum() / q.sum()))
 
-    def _calculate_values(self):
+        threshold, priceNode, spreadRho = self._prune_threshold, self.priceNode, self._spreadRho
+        self._calculate_values()
+        self._prune_threshold = 0
+        self._calculate_values()
+        full_price = self.get_price()
+        self._prune_threshold = threshold
+        pruned_price = priceNode - self._accruedInterest
+        self.priceNode, self._spreadRho = priceNode, spreadRho
+
+        return {'threshold': threshold,
+                'nodes': nodes,
+                'kept_nodes': kept,
+                'max_dropped_mass': dropped,
+                'price': pruned_price,
+                'full_price': full_price,
+                'price_error': pruned_price - full_price}
+
+    def _calculate_values_loop(self):
+        ''' Node by node backward induction, kept as the reference implementation
+            for _calculate_values.
+        '''
         price_length = min(self._numT + 1, self._j_max)
         if price_length <= 0:
             return -1
@@ -290,7 +482,7 @@ class OASModel():
 
             if i > 0:
                 self.priceDown1 = copy.deepcopy(self.priceDown)
-                self.priceUp1 = self.priceUp
+                self.priceUp1 = copy.deepcopy(self.priceUp)
                 self.priceNode1 = self.priceNode
         return 0
 
@@ -300,15 +492,170 @@ class OASModel():
     def get_price(self):
         return self.priceNode - self._accruedInterest
 
-    def Calculate_OAS(self, bond: Bond, curve: Curve, value_date: date, price: float, credit_spread: float):
-        ''' Return:
-              the implied credit spread for the market price
+    def Calculate_Prices(self, bonds: list, curve: Curve, value_date: date, credit_spreads) -> list:
+        ''' Value a list of bonds with one backward induction on a shared tree, the coupon,
+            accrued interest and call schedules are stacked into one row per bond. Bonds without
+            a call are valued in closed form if _use_closed_form is set, as in Calculate_Price.
+            The tree is uniform and not pruned, raises ValueError with _time_grid or _prune_threshold set.
+            Return:
+              list of clean prices, nan for matured bonds
             Params:
-              bond: the Bond
+              bonds: list of Bond
               curve: the Curve
               value_date: pricing date (settlement date)
-              price: market price
-              credit_spread: seed
+              credit_spreads: one spread for all bonds or a list with one spread per bond
+        '''
+        if self._time_grid:
+            raise ValueError("Stacked valuation needs the uniform time grid")
+        if self._prune_threshold > 0:
+            raise ValueError("Stacked valuation sweeps the full tree, set _prune_threshold to 0")
+        self._curve = curve
+        self._valueDate = value_date
+        if not isinstance(credit_spreads, (list, tuple, np.ndarray)):
+            credit_spreads = [credit_spreads] * len(bonds)
+
+        prices = [math.nan] * len(bonds)
+        numTs = []
+        for k, bond in enumerate(bonds):
+            if bond._coupon_schedule is None:
+                bond.calculate_coupon_schedule()
+            if self._use_closed_form and not bond.NextCallDate:
+                prices[k] = self.Calculate_Price(bond, curve, value_date, credit_spreads[k])
+                numTs.append(-1)
+                continue
+            self._curve = curve
+            self._valueDate = value_date
+            self._bond = bond
+            self._set_tree_params()
+            numTs.append(self._numT)
+        live = [k for k in range(len(bonds)) if numTs[k] >= 0]
+        if not live:
+            return prices
+
+        numT = max(numTs[k] for k in live)
+        self._times = np.arange(numT + 1) * self._dT
+        self._stepDays = self._times * 365.25
+        calibrated = self._get_calibrated_tree(numT)
+        if calibrated is None:
+            return prices
+
+        # stacked schedules, zero cash flows and no call after each bond's maturity
+        n = len(live)
+        cpn = np.zeros((n, numT + 1))
+        ai = np.zeros((n, numT + 1))
+        call = np.full((n, numT + 1), 1.0e+50)
+        redemption = np.zeros(n)
+        accrued = np.zeros(n)
+        maturing = {}
+        for row, k in enumerate(live):
+            self._bond = bonds[k]
+            self._numT = numTs[k]
+            self._set_future_coupons()
+            self._set_accrued_interest()
+            self._set_cpn_schedule()
+            self._set_ai_schedule()
+            self._set_call_schedule()
+            cpn[row, :self._numT+1] = self._cpnSchedule
+            ai[row, :self._numT+1] = self._AISchedule
+            call[row, :self._numT+1] = self._callPrice
+            redemption[row] = bonds[k].Redemption
+            accrued[row] = self._accruedInterest
+            maturing.setdefault(self._numT, []).append(row)
+
+        spreads = np.array([credit_spreads[k] for k in live])[:, np.newaxis]
+        values = np.zeros((n, 2 * min(numT, self._j_max) + 1))
+        for i in reversed(range(numT + 1)):
+            size = min(i, self._j_max)
+            if i < numT:
+                # the credit spread is added to the semi-annual compounded rate, see getDiscountFactors
+                discount = np.power(calibrated.getGrowths(i) + spreads / 2.0, -2.0 * self._dT)
+                values = self._p.expectValues(values, size) * discount + cpn[:, i:i+1]
+            rows = maturing.get(i)
+            if rows:
+                values[rows] = (redemption[rows] + cpn[rows, i])[:, np.newaxis]
+            callPay = call[:, i:i+1] + ai[:, i:i+1]
+            values = np.where(values >= call[:, i:i+1], np.minimum(values, callPay), values)
+
+        for row, k in enumerate(live):
+            prices[k] = float(values[row, 0] - accrued[row])
+        return prices
+
+    def get_spread_rho(self):
+        ''' Return: derivative of the dirty price to the credit spread '''
+        return self._spreadRho
+
+    def _price_at_spread(self, credit_spread: float) -> float:
+        ''' Run one backward sweep at the credit spread
+            Return:
+              clean price minus the target price, None on failure
+        '''
+        if self._levels:
+            return self._price_levels_at_spread(credit_spread)
+        self._set_credit_spread(credit_spread)
+        if self._closed_form:
+            self._calculate_closed_form_values()
+            return self.get_price() - self._target_price
+        if self._calculate_values() == -1:
+            return None
+        self._num_sweeps += 1
+        return self.get_price() - self._target_price
+
+    def _solve_spread(self, credit_spread: float, tolerance: float=None):
+        ''' Bracketed root search of the clean price in the credit spread, starting at credit_spread.
+            Steps use the spread derivative of the sweep (a secant through the last two points
+            if it vanishes) and fall back to bisection when they leave the bracket. Every
+            evaluation tightens the bracket, the price is decreasing in the spread.
+            Params:
+              tolerance: tolerance of the clean price, _price_tolerance if None
+            Return:
+              the credit spread, None on failure
+        '''
+        if tolerance is None:
+            tolerance = self._price_tolerance
+        diff = self._price_at_spread(credit_spread)
+        if diff is None:
+            return None
+        low, high = -math.inf, math.inf  # bracket of the spread
+        prev_spread, prev_diff = None, None
+
+        for count in range(self._max_iterations):
+            if math.fabs(diff) <= tolerance:
+                return credit_spread
+
+            if diff > 0:
+                low = max(low, credit_spread)
+            else:
+                high = min(high, credit_spread)
+
+            if math.fabs(self._spreadRho) > 1.0e-10:
+                step = -diff / self._spreadRho
+            elif prev_spread is not None and diff != prev_diff:
+                step = -diff * (credit_spread - prev_spread) / (diff - prev_diff)
+            else:
+                step = 0.01 if diff > 0 else -0.01
+            next_spread = credit_spread + step
+
+            if not low < next_spread < high:
+                if math.isinf(low) or math.isinf(high):
+                    # no bracket yet, step to the known side of the root
+                    next_spread = credit_spread + (0.01 if diff > 0 else -0.01)
+                else:
+                    next_spread = 0.5 * (low + high)
+            if math.fabs(next_spread - credit_spread) < self._spread_tolerance:
+                return next_spread
+
+            prev_spread, prev_diff = credit_spread, diff
+            credit_spread = next_spread
+            diff = self._price_at_spread(credit_spread)
+            if diff is None:
+                return None
+
+        return credit_spread if math.fabs(diff) <= tolerance else None
+
+    def _setup(self, bond: Bond, curve: Curve, value_date: date, credit_spread: float) -> int:
+        ''' Build the tree and the schedules of the bond at the credit spread
+            Return:
+              0 on success, -1 otherwise
         '''
         self._bond = bond
         self._curve = curve
@@ -316,48 +663,1091 @@ class OASModel():
 
         self._set_tree_params()
         self._set_credit_spread(credit_spread)
-        self._set_rate_tree()
-        self._set_credit_spread_to_rate_tree()
+        if self._set_rate_tree() == -1:
+            return -1
         self._set_future_coupons()
         self._set_accrued_interest()
         self._set_cpn_schedule()
         self._set_ai_schedule()
         self._set_call_schedule()
-        self._calculate_values()
+        return 0
 
-        dirty_price = self.get_dirty_price()
-        clean_price = self.get_price()
+    def _setup_closed_form(self, bond: Bond, curve: Curve, value_date: date, credit_spread: float) -> int:
+        ''' Set the future cash flows of an option-free bond, their times in years and the curve
+            rates at their dates, the rates of the calibration of the tree.
+            Return:
+              0 on success, -1 otherwise
+        '''
+        self._bond = bond
+        self._curve = curve
+        self._valueDate = value_date
+        self._closed_form = True
+        self._set_credit_spread(credit_spread)
+        if bond.Maturity <= value_date or curve._numRate <= 0:
+            return -1
+        self._set_future_coupons()
+        self._set_accrued_interest()
 
-        diff = clean_price - price
+        flows = {}
+        for i in range(max(self._numCoupon, 0)):
+            if self._couponDates[i] >= value_date:
+                flows[self._couponDates[i]] = flows.get(self._couponDates[i], 0.0) + self._couponAmounts[i]
+        flows[bond.Maturity] = flows.get(bond.Maturity, 0.0) + bond.Redemption
+
+        today = utilities.toDateNumber(value_date)
+        days = [utilities.toDateNumber(d) for d in flows]
+        self._cashFlows = np.array(list(flows.values()))
+        self._cashFlowTimes = (np.array(days) - today) / 365.25
+        self._cashFlowRates = curve.getRates(days)
+        return 0
 
-        count = 0 # num of iterations
-        while math.fabs(diff) > 0.01 and count < 10:
-            self._add_shift_to_rate_tree(10 * 0.0001) # change by 1 bp
-            err = self._calculate_values()
-            if err == -1:
+    def _calculate_closed_form_values(self):
+        ''' Discount the cash flows at the semi-annual compounded curve rates plus the credit spread,
+            the spread is added as in adjustRatesByCreditSpread, and its derivative to the spread.
+            Return:
+              0
+        '''
+        base = 1.0 + (self._cashFlowRates + self._credit_spread) / 2.0
+        discount = np.power(base, -2.0 * self._cashFlowTimes)
+        values = self._cashFlows * discount
+        self.priceNode = float(values.sum())
+        self._spreadRho = float(-np.dot(values, self._cashFlowTimes / base))
+        return 0
+
+    def _price_levels_at_spread(self, credit_spread: float) -> float:
+        ''' Sweep the finest (up to three) trees of the precision mode at the credit spread and
+            Richardson extrapolate their dirty prices and spread derivatives in the step length,
+            the error estimate is the change from the next lower order.
+            Return:
+              extrapolated clean price minus the target price, None on failure
+        '''
+        levels = self._levels[-3:]
+        prices, rhos = [], []
+        for level in levels:
+            if level._price_at_spread(credit_spread) is None:
+                return None
+            prices.append(level.get_dirty_price())
+            rhos.append(level.get_spread_rho())
+        self._num_sweeps += len(levels)
+        self._credit_spread = credit_spread
+
+        (self.priceNode, self._spreadRho), previous = self._extrapolate([prices, rhos])
+        self._extrapolation_error = math.fabs(self.priceNode - previous[0]) if previous else math.inf
+        self._level_prices = [p - self._accruedInterest for p in prices]
+        return self.get_price() - self._target_price
+
+    def _extrapolate(self, sequences: list) -> tuple:
+        ''' Romberg table with step ratio 2 and error terms in dt, dt^2 over the values of
+            the levels, coarsest first, each sequence is extrapolated on its own.
+            Return:
+              tuple of the list of extrapolated values and the list of the next lower order
+              estimates, None with a single level
+        '''
+        estimates = sequences
+        previous = None
+        for order in range(1, len(sequences[0])):
+            previous = [e[-1] for e in estimates]
+            factor = 2 ** order - 1
+            estimates = [[e[j] + (e[j] - e[j-1]) / factor for j in range(1, len(e))] for e in estimates]
+        return [e[-1] for e in estimates], previous
+
+    def _calculate_oas_with_precision(self, bond: Bond, curve: Curve, value_date: date, credit_spread: float,
+                                      tolerance: float=None) -> float:
+        ''' Solve the OAS on Richardson extrapolated prices of coupon aligned grids, halving the
+            steps of the grid until the error estimate of the extrapolated price is within
+            _price_precision or _precision_max_levels grids are used. The cash flows are on the
+            nodes of every grid, so the price converges smoothly in the step length.
+            Return:
+              the implied credit spread, -1 on failure
+        '''
+        self._bond = bond
+        self._curve = curve
+        self._valueDate = value_date
+        self._levels = []
+        self._extrapolation_error = math.inf
+        oas = None
+        grid = self._precision_grid or self._time_grid or timeGrid(0.04, 0.5, 0.04, 0.04)
+        for _ in range(self._precision_max_levels):
+            level = OASModel()
+            level._time_grid = grid
+            if self._stats is not None:
+                level._instrument(self._stats)
+            if level._setup(bond, curve, value_date, credit_spread) == -1:
+                break
+            level._target_price = self._target_price
+            level._num_sweeps = 0
+            self._levels.append(level)
+            self._accruedInterest = level._accruedInterest
+
+            if len(self._levels) >= 2:
+                oas = self._solve_spread(credit_spread, tolerance)
+                if oas is None:
+                    break
+                credit_spread = oas
+                if self._extrapolation_error <= self._price_precision:
+                    break
+            grid = grid.refine()
+
+        self._precision_report = {'steps': [level._numT for level in self._levels],
+                                  'dt_min': [level._time_grid.dt_min for level in self._levels],
+                                  'prices': self._level_prices if len(self._levels) >= 2 else [],
+                                  'price': self.get_price() if oas is not None else None,
+                                  'error_estimate': self._extrapolation_error,
+                                  'converged': oas is not None and self._extrapolation_error <= self._price_precision,
+                                  'sweeps': self._num_sweeps}
+        return -1 if oas is None else oas
+
+    def get_precision_report(self) -> dict:
+        ''' Return:
+              dict of the last precision mode OAS: the number of steps and the smallest step of each
+              grid used, the clean prices of the finest trees and the extrapolated clean price at the OAS,
+              its error estimate, whether it is within _price_precision and the number of backward sweeps
+        '''
+        return self._precision_report
+
+    def Calculate_OAS(self, bond: Bond, curve: Curve, value_date: date, price: float, credit_spread: float, tolerance: float=None):
+        ''' Return:
+              the implied credit spread for the market price, -1 on failure
+            Params:
+              bond: the Bond
+              curve: the Curve
+              value_date: pricing date (settlement date)
+              price: market price
+              credit_spread: seed, e.g. the previous OAS of the bond as a warm start
+              tolerance: tolerance of the clean price, _price_tolerance if None
+            With _price_precision set, the price is Richardson extrapolated over refined time grids
+            until it is within _price_precision, see get_precision_report().
+            Bonds without a call are valued in closed form if _use_closed_form is set, the OAS is
+            then the Z-spread to the curve.
+        '''
+        if self._profile:
+            self._instrument(phaseStats())
+        elif self._stats is not None:
+            self._instrument(None)
+        self._target_price = price
+        self._num_sweeps = 0
+        self._closed_form = False
+        self._levels = []
+        self._oas = None
+        oas = self._calculate_oas(bond, curve, value_date, credit_spread, tolerance)
+        if self._stats is not None:
+            self._stats.count('solver_iterations', self._num_sweeps)
+            self._stats.count('Calculate_OAS')
+            PROCESS_STATS.merge(self._stats)
+        return oas
+
+    def _calculate_oas(self, bond: Bond, curve: Curve, value_date: date, credit_spread: float,
+                       tolerance: float=None) -> float:
+        if self._use_closed_form and not bond.NextCallDate:
+            if self._setup_closed_form(bond, curve, value_date, credit_spread) == -1:
+                return -1
+            oas = self._solve_spread(credit_spread, tolerance)
+        elif self._price_precision:
+            oas = self._calculate_oas_with_precision(bond, curve, value_date, credit_spread, tolerance)
+            oas = None if oas == -1 else oas
+        else:
+            if self._setup(bond, curve, value_date, credit_spread) == -1:
                 return -1
+            oas = self._solve_spread(credit_spread, tolerance)
+        if oas is None:
+            return -1
+        self._oas = oas
+        return oas
+
+    def Calculate_Price(self, bond: Bond, curve: Curve, value_date: date, credit_spread: float) -> float:
+        ''' Return:
+              the clean price at the credit spread, nan on failure. Bonds without a call are
+              valued in closed form if _use_closed_form is set, others on a single tree.
+        '''
+        self._levels = []
+        self._closed_form = False
+        if self._use_closed_form and not bond.NextCallDate:
+            err = self._setup_closed_form(bond, curve, value_date, credit_spread)
+        else:
+            err = self._setup(bond, curve, value_date, credit_spread)
+        if err == -1 or self._price_at_spread(credit_spread) is None:
+            return math.nan
+        return self.get_price()
+
+    PROFILED = ('_set_tree_params', '_set_rate_tree', '_set_future_coupons', '_set_accrued_interest',
+                '_set_cpn_schedule', '_set_ai_schedule', '_set_call_schedule', '_calculate_values',
+                '_setup_closed_form', '_calculate_closed_form_values')
+
+    def _instrument(self, stats: phaseStats):
+        ''' Time the PROFILED methods of this model in stats, by wrapping them as instance
+            attributes, so there is no cost without profiling. None removes the wrappers.
+        '''
+        self._stats = stats
+        for name in self.PROFILED:
+            if stats is None:
+                self.__dict__.pop(name, None)
+            else:
+                setattr(self, name, stats.timed(name, getattr(type(self), name).__get__(self)))
+
+    def __getstate__(self):
+        # the wrappers of _instrument are bound to this model, a copy instruments itself again
+        return {k: v for k, v in self.__dict__.items() if k not in self.PROFILED}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._stats is not None:
+            self._instrument(self._stats)
+
+    def _settings_key(self) -> tuple:
+        ''' Return: hashable key of the model type and of the settings its prices depend on '''
+        grids = tuple(None if grid is None else (grid.dt_min, grid.dt_max, grid.growth, grid.dt_call)
+                      for grid in (self._time_grid, self._precision_grid))
+        return (type(self), self._yearly_time_step, grids, self._prune_threshold, self._use_closed_form,
+                self._price_precision, self._precision_max_levels)
+
+    def get_stats(self) -> phaseStats:
+        ''' Return: phaseStats of the last Calculate_OAS with _profile set, None otherwise.
+            PROCESS_STATS aggregates all of them in the process.
+        '''
+        return self._stats
+
+    def Calculate_Risk(self, shift: float=0.0001) -> dict:
+        ''' Effective duration, convexity and DV01 at the OAS of the last Calculate_OAS, by shifting
+            all rates of the tree in parallel by +/- shift (semi-annual compounded, as the credit
+            spread). The tree and the schedules of the OAS are reused, so this costs three sweeps.
+            Return:
+              dict with the OAS, the clean and dirty price at the OAS, effective duration and
+              convexity of the dirty price and DV01 (price change for 1bp down), None on failure
+            Params:
+              shift: size of the parallel shift, 1bp by default
+        '''
+        if self._oas is None:
+            return None
+        sweeps = self._num_sweeps
+        if self._price_at_spread(self._oas + shift) is None:
+            return None
+        price_up = self.get_dirty_price()
+        if self._price_at_spread(self._oas - shift) is None:
+            return None
+        price_down = self.get_dirty_price()
+        # last at the OAS, so the model is left at the solved spread
+        if self._price_at_spread(self._oas) is None:
+            return None
+        price = self.get_dirty_price()
+        self._num_sweeps = sweeps
+
+        return {'OAS': float(self._oas),
+                'price': self.get_price(),
+                'dirty_price': price,
+                'effective_duration': (price_down - price_up) / (2.0 * shift * price),
+                'effective_convexity': (price_down + price_up - 2.0 * price) / (shift * shift * price),
+                'DV01': (price_down - price_up) / (2.0 * shift) * 0.0001}
+
+
+    def _calculate_curve_sensitivities(self):
+        ''' Derivatives of the dirty price at the current credit spread to the rates of the curve
+            points. The backward sweep keeps the expected values and the nodes where the call does
+            not bind, the adjoint of the sweep then carries the weight of every node forward from
+            the root, d price / d rate = weight * expected value * d discount / d rate, and
+            calibratedTree.getCurveSensitivities takes it through the calibration. This costs
+            about two sweeps and a pass over the calibration, for all curve points at once.
+            Return:
+              array with one derivative per curve point, None on failure
+        '''
+        if self._closed_form:
+            base = 1.0 + (self._cashFlowRates + self._credit_spread) / 2.0
+            values = self._cashFlows * np.power(base, -2.0 * self._cashFlowTimes)
+            self.priceNode = float(values.sum())
+            sensitivities = np.zeros(self._curve._numRate)
+            today = utilities.toDateNumber(self._valueDate)
+            for rbar, t in zip(-values * self._cashFlowTimes / base, self._cashFlowTimes):
+                for k, w in self._curve.getRateWeights(today + t * 365.25):
+                    sensitivities[k] += rbar * w
+            return sensitivities
+        if self._levels:
+            # extrapolated as the prices of the precision mode
+            prices, sensitivities = [], []
+            for level in self._levels[-3:]:
+                level._set_credit_spread(self._credit_spread)
+                sensitivities.append(level._calculate_curve_sensitivities())
+                if sensitivities[-1] is None:
+                    return None
+                prices.append(level.get_dirty_price())
+            (self.priceNode, sensitivities), _ = self._extrapolate([prices, sensitivities])
+            return sensitivities
+        if self._numT < 0:
+            return None
+        # the full tree, the adjoint goes through its calibration
+        tree = self._gridTree if self._time_grid else self._calibratedTree
 
-            dirty_price2 = self.get_dirty_price()
-            spread_rho = (dirty_price2 - dirty_price) / 0.001
+        # backward sweep
+        expectations, kept = [None] * self._numT, [None] * self._numT
+        self._sweep(tree, expectations, kept)
 
-            if math.fabs(spread_rho) < 0.001:
-                return credit_spread
+        # adjoint sweep, d discount / d rate = -dt * discount * exp(r/2) / (exp(r/2) + s/2)
+        weights = tree.getQ(0).copy()
+        rate_adjoints = []
+        for i in range(self._numT):
+            discount, _ = tree.getDiscountFactors(i, tree.getDt(i), self._credit_spread)
+            weights = weights * kept[i]
+            with np.errstate(over='ignore'):
+                # growths overflow to inf on the far nodes, their derivative is then -dt * discount
+                derivatives = -tree.getDt(i) * discount / (1.0 + self._credit_spread / (2.0 * tree.getGrowths(i)))
+            rate_adjoints.append(weights * expectations[i] * derivatives)
+            weights = tree.propagate(i, weights * discount)
+        rate_adjoints.append(np.zeros(weights.size))
+        return tree.getCurveSensitivities(rate_adjoints)
+
+    def Calculate_Key_Rate_Durations(self) -> dict:
+        ''' Key rate durations to every point of the curve at the OAS of the last Calculate_OAS,
+            from one adjoint pass through the sweep and the calibration of the tree.
+            Return:
+              dict with the dates of the curve points, the derivatives of the dirty price to their
+              rates, the key rate durations (minus the derivatives over the dirty price) and the
+              dirty price, None on failure
+        '''
+        if self._oas is None:
+            return None
+        self._set_credit_spread(self._oas)
+        sensitivities = self._calculate_curve_sensitivities()
+        if sensitivities is None:
+            return None
+        price = self.get_dirty_price()
+        return {'dates': [d[0] for d in self._curve.get_curve_data()],
+                'sensitivities': sensitivities.tolist(),
+                'key_rate_durations': (-sensitivities / price).tolist(),
+                'dirty_price': price}
+
+
+class calibratedTree():
+    ''' Rates and Q (Arrow-Debreu prices) of a tree calibrated to a curve, one array per time step
+        ordered from level -size to level +size. The calibration of a step only depends on the
+        earlier steps, so a tree can be extended to a longer horizon and its prefix reused.
+        The steps are stored back to back (CSR layout) in one float64 array with a row each for
+        the rates, their growth factors and Q, step i is at columns _offsets[i].._offsets[i+1]-1.
+    '''
+    ROWS = 3  # rates, growth factors, Q
+    def __init__(self, curve: Curve, yearly_time_step: int) -> None:
+        self._curve = curve
+        self._dT = 1.0 / yearly_time_step
+        self._a = curve._mean_reversion
+        self._j_max = int(0.184 * yearly_time_step / self._a)
+        self._u = math.exp(curve._ir_vol * math.sqrt(3.0 * self._dT))
+        self._p = nodeProbability()
+        self._p.setJmax(self._j_max)
+        self._p.setNodeProbability(self._dT, self._a)
+
+        self._data = np.empty((self.ROWS, 0))
+        self._offsets = [0]
+        self._multiplier = 0
+        self._windows = {}
+
+    def getNumT(self) -> int:
+        return len(self._offsets) - 2
+
+    def getRates(self, i: int):
+        return self._data[0, self._offsets[i]:self._offsets[i+1]]
+
+    def getQ(self, i: int):
+        return self._data[2, self._offsets[i]:self._offsets[i+1]]
+
+    def getGrowths(self, i: int):
+        ''' Return: the semi-annual growth factors exp(r/2) = 1 + r_sa/2 of the rates at step i '''
+        return self._data[1, self._offsets[i]:self._offsets[i+1]]
 
-            credit_spread -= diff / spread_rho
-            self._set_credit_spread(credit_spread);  # set new credit spread
-            self._add_shift_to_rate_tree(-10 * 0.0001 - diff / spread_rho)
+    def getDt(self, i: int) -> float:
+        return self._dT
 
-            err = self._calculate_values()
+    def getWidth(self, i: int) -> int:
+        return self._offsets[i+1] - self._offsets[i]
+
+    def getBase(self, i: int):
+        ''' Return: the rates of step i over the multiplier, u^j for level j=-size..size '''
+        size = min(i, self._j_max)
+        return self._u ** np.arange(-size, size+1)
+
+    def getCalibrationTime(self, i: int) -> float:
+        ''' Return: the time in years of the curve discount factor step i is calibrated to '''
+        return (i+1) * self._dT
+
+    def expect(self, i: int, values):
+        ''' Return: the expectation at the nodes of step i of the values at step i+1 '''
+        return self._p.expectValues(values, min(i, self._j_max))
+
+    def propagate(self, i: int, weights):
+        ''' Return: the weights at the nodes of step i carried forward to step i+1, the transpose of expect '''
+        return self._p.propagateQ(weights, min(i+1, self._j_max))
+
+    def getNodeRate(self, i: int) -> float:
+        return float(self._data[0, (self._offsets[i] + self._offsets[i+1]) // 2])
+
+    def getUpRate(self, i: int, index: int) -> float:
+        ''' Return: the rate of level index+1 at step i, as treeBranch.getUpRate '''
+        return float(self._data[0, (self._offsets[i] + self._offsets[i+1]) // 2 + 1 + index])
+
+    def getDownRate(self, i: int, index: int) -> float:
+        ''' Return: the rate of level -(index+1) at step i, as treeBranch.getDownRate '''
+        return float(self._data[0, (self._offsets[i] + self._offsets[i+1]) // 2 - 1 - index])
+
+    def getDiscountFactors(self, i: int, dt: float, credit_spread: float, nodes: slice=None) -> tuple:
+        ''' The credit spread is added to the semi-annual compounded rates, as in
+            treeBranch.adjustRatesByCreditSpread, so the one-step discount factors are
+            (exp(r/2) + s/2)^(-2*dt), one power per node and no change to the calibrated rates.
+            Params:
+              nodes: slice of the nodes of step i, e.g. the window kept by pruning, None for all
+            Return:
+              tuple of the discount factors of step i and their derivatives to the spread
+        '''
+        growth = (self.getGrowths(i) if nodes is None else self.getGrowths(i)[nodes]) + credit_spread / 2.0
+        discount = np.power(growth, -2.0 * dt)
+        return discount, -dt * discount / growth
+
+    def getSize(self) -> int:
+        ''' Return: memory used by the rate, growth factor and Q arrays in bytes '''
+        return self._data.nbytes
+
+    def getWindows(self, threshold: float, numT: int) -> list:
+        ''' Prune the tails of the Q distribution: at every step, drop the levels on each side
+            whose accumulated Q is at most threshold times the total Q of the step.
+            The windows are memoized per threshold.
+            Return:
+              list of (lo, hi), the lowest and highest level kept at steps 0..numT
+        '''
+        windows = self._windows.setdefault(threshold, [])
+        for i in range(len(windows), min(numT, self.getNumT()) + 1):
+            q = self.getQ(i)
+            size = (q.size - 1) // 2
+            cut = threshold * q.sum()
+            lo = min(int(np.searchsorted(np.cumsum(q), cut, side='right')), size)
+            hi = max(q.size - 1 - int(np.searchsorted(np.cumsum(q[::-1]), cut, side='right')), size)
+            windows.append((lo - size, hi - size))
+        return windows
+
+    def _append(self, rates, q):
+        begin = self._offsets[-1]
+        end = begin + rates.size
+        if end > self._data.shape[1]:
+            # grow geometrically, the views of earlier steps keep the old buffer alive
+            data = np.empty((self.ROWS, max(end, 2 * self._data.shape[1], 64)))
+            data[:, :begin] = self._data[:, :begin]
+            self._data = data
+        self._data[0, begin:end] = rates
+        with np.errstate(over='ignore'):
+            np.exp(rates / 2.0, out=self._data[1, begin:end])
+        self._data[2, begin:end] = q
+        self._offsets.append(end)
+
+    def rebase(self, curve: Curve) -> calibratedTree:
+        ''' A tree calibrated to a new curve, which reuses the steps calibrated to curve dates
+            where the rates did not change. Step i only depends on the curve discount factor at
+            its calibration time and the earlier steps, so the steps before the first changed
+            calibration date are copied and the tree is extended from there.
+            Return:
+              the new tree with the unchanged steps, extend() calibrates the rest
+        '''
+        change = self._curve.getChangeDate(curve)
+        today = utilities.toDateNumber(self._curve._valueDate)
+        steps = 0
+        while steps <= self.getNumT() and today + self.getCalibrationTime(steps) * 365.25 < change:
+            steps += 1
+
+        tree = copy.copy(self)
+        tree._curve = curve
+        tree._windows = {}
+        tree._offsets = self._offsets[:steps+1]
+        tree._data = self._data[:, :self._offsets[steps]].copy()
+        tree._multiplier = float(self.getRates(steps-1)[0] / self.getBase(steps-1)[0]) if steps > 0 else 0
+        return tree
+
+    def __getstate__(self):
+        # pickle the used part of the buffer only
+        state = self.__dict__.copy()
+        state['_data'] = self._data[:, :self._offsets[-1]].copy()
+        return state
+
+    def extend(self, numT: int, stats: phaseStats=None) -> int:
+        ''' Calibrate by forward induction of Q up to step numT.
+            Rates at step i are multiplier * u^j for level j=-size..size, the multiplier is solved
+            so that the Q weighted one-step discount factors reprice the curve discount factor.
+            Params:
+              stats: phaseStats to time every multiplier solve in, None for no profiling
+            Return:
+              0 on success, -1 otherwise
+        '''
+        solve = self._solve_multiplier if stats is None else stats.timed('_solve_multiplier', self._solve_multiplier)
+        if self.getNumT() < 0:
+            tree = treeBranch()
+            tree.setBranch(0)
+            err = tree.adjustTreeNodes(self._curve, self._dT, 0, self._p)
             if err == -1:
                 return -1
+            self._append(tree.getRates(), np.ones(1))
+            self._multiplier = tree.getNodeRate()
+
+        today = utilities.toDateNumber(self._curve._valueDate)
+        first = self.getNumT() + 1
+        dFs = self._curve.getDiscountFactors(today + np.arange(first + 1, numT + 2) * self._dT * 365.25)
+        for i in range(first, numT+1):
+            q = self.propagate(i-1, self.getQ(i-1) * np.exp(-self.getRates(i-1) * self._dT))
+            dF = dFs[i - first]
+
+            base = self.getBase(i)
+            multiplier = solve(q, base * self._dT, dF, self._multiplier)
+            if multiplier < 0:
+                print("cannot find multiplier")
+                return -1
+            self._multiplier = multiplier
+            self._append(multiplier * base, q)
+        return 0
 
-            dirty_price = self.get_dirty_price()
-            clean_price = self.get_price()
-            diff = clean_price-price
+    def getCurveSensitivities(self, rate_adjoints) -> np.ndarray:
+        ''' Reverse mode through the calibration: the rates at step i are m_i * base_i, where m_i
+            solves sum(Q_i * exp(-m_i * base_i * dt_i)) = dF_i and Q_i depends on m_0..m_i-1.
+            Going back from the last step, the adjoint of m_i collects the direct term and the
+            terms of Q_i+1, it is passed to the curve discount factor dF_i and to Q_i by the
+            implicit function theorem.
+            Params:
+              rate_adjoints: derivatives of a value to the rates, one array per step 0..numT
+            Return:
+              array of the derivatives of the value to the rates of the curve points
+        '''
+        curve = self._curve
+        sensitivities = np.zeros(curve._numRate)
+        today = utilities.toDateNumber(curve._valueDate)
+        qbar = None
+        for i in reversed(range(len(rate_adjoints))):
+            base = self.getBase(i)
+            mbar = float(np.dot(rate_adjoints[i], base))
+            t = self.getCalibrationTime(i)
+            rate = curve.getTheRate(today + t * 365.25)
+            dt = self.getDt(i)
+            q = self.getQ(i)
+            discount = np.exp(-self.getRates(i) * dt)
+            if qbar is not None:
+                expected = self.expect(i, qbar)
+                mbar -= float(np.dot(expected * q * discount, base)) * dt
+                qbar = expected * discount
+            else:
+                qbar = np.zeros(q.size)
+            if i == 0:
+                # m_0 is the continuously compounded curve rate
+                rbar = mbar / (1.0 + rate / 2.0)
+            else:
+                dPhi = -float(np.dot(q * discount, base)) * dt
+                qbar = qbar - mbar * discount / dPhi
+                dF = math.exp(-utilities.DCToCC(rate, 2) * t)
+                rbar = mbar / dPhi * dF * -t / (1.0 + rate / 2.0)
+            for k, w in curve.getRateWeights(today + t * 365.25):
+                sensitivities[k] += rbar * w
+        return sensitivities
+
+    @staticmethod
+    def _solve_multiplier(q, bdT, dF: float, guess: float) -> float:
+        ''' Newton iteration on sum(q * exp(-m * bdT)) = dF, bdT is the base rates times the step length.
+            The function is convex and decreasing in m, so the iteration converges
+            monotonically once it is left of the root.
+            Return:
+              the multiplier m in [0, 1], -1 if the root is not bracketed
+        '''
+        if q.sum() < dF or np.dot(q, np.exp(-bdT)) > dF:
+            return -1
 
-            count += 1
+        m = min(max(guess, 0.0), 1.0)
+        for _ in range(100):
+            terms = q * np.exp(-m * bdT)
+            diff = terms.sum() - dF
+            if math.fabs(diff) < 1.0e-15:
+                break
+            step = diff / np.dot(terms, bdT)
+            m = max(m + step, 0.0)
+            if math.fabs(step) < 1.0e-15:
+                break
+        return m
 
-        return credit_spread
+
+class timeGrid():
+    ''' Builder of a non-uniform time grid for a bond. The coupon dates, the call date and the
+        maturity are nodes, in between the steps grow linearly from dt_min at the value date
+        by growth per year up to dt_max, and are at most dt_call in the call period.
+    '''
+    def __init__(self, dt_min: float=0.01, dt_max: float=0.25, growth: float=0.02, dt_call: float=0.02) -> None:
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.growth = growth
+        self.dt_call = dt_call
+
+    def refine(self) -> timeGrid:
+        ''' Return: the grid with all step lengths halved '''
+        return timeGrid(self.dt_min / 2, self.dt_max / 2, self.growth / 2, self.dt_call / 2)
+
+    def build(self, bond: Bond, value_date: date):
+        ''' Return:
+              array of the step times in years from the value date, 0 first and the maturity last
+        '''
+        today = utilities.toDateNumber(value_date)
+        maturity = (utilities.toDateNumber(bond.Maturity) - today) / 365.25
+        if maturity < 0:
+            return np.zeros(0)
+        call = (utilities.toDateNumber(bond.NextCallDate) - today) / 365.25 if bond.NextCallDate else math.inf
+
+        nodes = {0.0, maturity}
+        if 0 < call < maturity:
+            nodes.add(call)
+        for cpn in bond._coupon_schedule or []:
+            t = (utilities.toDateNumber(cpn.couponDate) - today) / 365.25
+            if 0 < t < maturity:
+                nodes.add(t)
+        nodes = sorted(nodes)
+
+        times = [0.0]
+        for begin, end in zip(nodes[:-1], nodes[1:]):
+            dt = min(self.dt_max, self.dt_min + self.growth * begin)
+            if begin >= call:
+                dt = min(dt, self.dt_call)
+            n = max(1, math.ceil((end - begin) / dt - 1.0e-9))
+            times.extend(begin + (end - begin) * k / n for k in range(1, n))
+            times.append(end)
+        return np.array(times)
+
+
+class gridTree(calibratedTree):
+    ''' Tree on a non-uniform time grid. The level spacing at step i+1 is vol * sqrt(3 * dt_i),
+        so it changes with the step length, and every node branches to the three levels of the next
+        step around the nearest level to its expected value (Hull-White 1996). The tree recombines
+        on the level grid of each step, its width is bounded by mean reversion instead of j_max.
+    '''
+    def __init__(self, curve: Curve, times) -> None:
+        self._curve = curve
+        self._times = times
+        self._a = curve._mean_reversion
+        self._vol = curve._ir_vol
+
+        self._data = np.empty((self.ROWS, 0))
+        self._offsets = [0]
+        self._multiplier = 0
+        self._windows = {}
+
+        # levels and branching, step i covers levels lo_i..hi_i with spacing dx_i
+        numT = len(times) - 1
+        # a bond maturing on the value date has the single step 0, calibrated over a day as in pdeGrid
+        self._dts = np.diff(times) if numT > 0 else np.full(1, 1.0 / 365.25)
+        self._lo = [0]
+        self._hi = [0]
+        self._dx = [0.0]
+        self._branches = []
+        for i in range(numT):
+            dt = self._dts[i]
+            dx = self._vol * math.sqrt(3.0 * dt)
+            levels = np.arange(self._lo[i], self._hi[i] + 1)
+            expected = levels * self._dx[i] * (1.0 - self._a * dt)
+            mid = np.rint(expected / dx).astype(int)
+            h = expected / dx - mid
+            lo, hi = int(mid[0]) - 1, int(mid[-1]) + 1
+            idx = mid - lo
+            self._branches.append((1.0/6.0 + (h*h + h) / 2.0, 2.0/3.0 - h*h, 1.0/6.0 + (h*h - h) / 2.0, idx + 1, idx, idx - 1))
+            self._lo.append(lo)
+            self._hi.append(hi)
+            self._dx.append(dx)
+
+    def getDt(self, i: int) -> float:
+        # the last step is calibrated with the step length before it
+        return self._dts[i] if i < len(self._dts) else self._dts[-1]
+
+    def getWidth(self, i: int) -> int:
+        return self._hi[i] - self._lo[i] + 1
+
+    def getBase(self, i: int):
+        return np.exp(np.arange(self._lo[i], self._hi[i] + 1) * self._dx[i])
+
+    def getCalibrationTime(self, i: int) -> float:
+        return self._times[i] + (self._dts[i] if i < len(self._dts) else self._dts[-1])
+
+    def expect(self, i: int, values):
+        pu, pm, pd, up, mid, down = self._branches[i]
+        # take on the node axis, much faster than fancy indexing of the last axis
+        return pu * values.take(up, axis=-1) + pm * values.take(mid, axis=-1) + pd * values.take(down, axis=-1)
+
+    def propagate(self, i: int, weights):
+        pu, pm, pd, up, mid, down = self._branches[i]
+        width = self.getWidth(i+1)
+        return (np.bincount(up, weights * pu, width) + np.bincount(mid, weights * pm, width)
+                + np.bincount(down, weights * pd, width))
+
+    def extend(self, numT: int, stats: phaseStats=None) -> int:
+        ''' Calibrate by forward induction of Q up to step numT, see calibratedTree.extend
+            Return:
+              0 on success, -1 otherwise
+        '''
+        solve = self._solve_multiplier if stats is None else stats.timed('_solve_multiplier', self._solve_multiplier)
+        numT = min(numT, len(self._times) - 1)
+        today = utilities.toDateNumber(self._curve._valueDate)
+        first = self.getNumT() + 1
+        dFs = self._curve.getDiscountFactors(today + np.array([self.getCalibrationTime(i) for i in range(first, numT+1)]) * 365.25)
+        for i in range(first, numT+1):
+            dt = self._dts[i] if i < len(self._dts) else self._dts[-1]
+            if i == 0:
+                rate = self._curve.getTheRate(today + 365.25 * dt)
+                self._multiplier = utilities.DCToCC(rate, 2)
+                self._append(np.array([self._multiplier]), np.ones(1))
+                continue
+
+            q = self.propagate(i-1, self.getQ(i-1) * np.exp(-self.getRates(i-1) * self._dts[i-1]))
+            dF = dFs[i - first]
+
+            base = self.getBase(i)
+            multiplier = solve(q, base * dt, dF, self._multiplier)
+            if multiplier < 0:
+                print("cannot find multiplier")
+                return -1
+            self._multiplier = multiplier
+            self._append(multiplier * base, q)
+        return 0
+
+
+class prunedTree():
+    ''' View of a calibratedTree on the levels kept by pruning at every step, see
+        calibratedTree.getWindows(), with the interface of the backward sweep. A branch into a
+        pruned node takes the value of the nearest kept node of the next step, and the discount
+        factors are computed for the kept nodes only.
+    '''
+    def __init__(self, tree: calibratedTree, threshold: float, numT: int) -> None:
+        self._tree = tree
+        self._threshold = threshold
+        windows = tree.getWindows(threshold, numT)
+        self._nodes = []
+        self._branches = []
+        for i in range(numT + 1):
+            lo, hi = windows[i]
+            size = min(i, tree._j_max)
+            self._nodes.append(slice(lo + size, hi + size + 1))
+            if i < numT:
+                self._branches.append(tree._p.windowBranches(lo, hi, *windows[i+1]))
+
+    def getThreshold(self) -> float:
+        return self._threshold
+
+    def getDt(self, i: int) -> float:
+        return self._tree.getDt(i)
+
+    def getWidth(self, i: int) -> int:
+        return self._nodes[i].stop - self._nodes[i].start
+
+    def getQ(self, i: int):
+        return self._tree.getQ(i)[self._nodes[i]]
+
+    def expect(self, i: int, values):
+        pu, pm, pd, up, mid, down = self._branches[i]
+        # take on the node axis, much faster than fancy indexing of the last axis
+        return pu * values.take(up, axis=-1) + pm * values.take(mid, axis=-1) + pd * values.take(down, axis=-1)
+
+    def getDiscountFactors(self, i: int, dt: float, credit_spread: float) -> tuple:
+        return self._tree.getDiscountFactors(i, dt, credit_spread, self._nodes[i])
+
+
+class rateTreeCache():
+    ''' Process wide LRU cache of calibrated trees keyed by curve and tree parameters,
+        evicting the least recently used trees once the arrays exceed max_bytes.
+    '''
+    def __init__(self, max_bytes: int=512 * 1024 * 1024) -> None:
+        self._max_bytes = max_bytes
+        self._trees = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rebases = 0  # misses served from a tree of the same parameters on an earlier curve
+
+    def setMaxBytes(self, max_bytes: int):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self._nbytes = 0
+
+    def getSize(self) -> int:
+        return self._nbytes
+
+    def getTree(self, curve: Curve, yearly_time_step: int, numT: int, stats: phaseStats=None) -> calibratedTree:
+        ''' Return:
+              the calibrated tree for the curve with at least numT steps, None if the calibration fails
+        '''
+        key = (curve.cache_key(), yearly_time_step)
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is None:
+                self.misses += 1
+                tree = self._rebase(curve, yearly_time_step)
+                if tree is None:
+                    tree = calibratedTree(curve, yearly_time_step)
+                else:
+                    self.rebases += 1
+                    self._nbytes += tree.getSize()
+                self._trees[key] = tree
+            else:
+                self.hits += 1
+                self._trees.move_to_end(key)
+
+            if tree.getNumT() < numT:
+                before = tree.getSize()
+                err = tree.extend(numT, stats)
+                self._nbytes += tree.getSize() - before
+                self._evict()
+                if err == -1:
+                    return None
+            return tree
+
+    def _rebase(self, curve: Curve, yearly_time_step: int) -> calibratedTree:
+        ''' Return:
+              the cached tree of the same parameters whose curve changes last rebased to the curve,
+              None if no cached tree shares a step with the curve
+        '''
+        best, best_change = None, curve._valueDateNum
+        for (key, step), tree in reversed(self._trees.items()):
+            if step != yearly_time_step or key[:4] != curve.cache_key()[:4]:
+                continue
+            change = tree._curve.getChangeDate(curve)
+            if change > best_change:
+                best, best_change = tree, change
+        return best.rebase(curve) if best is not None else None
+
+    def _evict(self):
+        # the most recently used tree is always kept
+        while self._nbytes > self._max_bytes and len(self._trees) > 1:
+            _, tree = self._trees.popitem(last=False)
+            self._nbytes -= tree.getSize()
+
+
+TREE_CACHE = rateTreeCache()
+
+
+class phaseStats():
+    ''' Call counts and wall time of the phases of an OAS calculation, and counters '''
+    def __init__(self) -> None:
+        self._phases = {}  # name: [calls, seconds]
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        rtn = [f"{name:<32}{calls:>10}{seconds:>12.6f}" for name, (calls, seconds) in self._phases.items()]
+        rtn += [f"{name:<32}{count:>10}" for name, count in self._counts.items()]
+        return "\n".join(rtn)
+
+    def __getstate__(self):
+        return {'_phases': self._phases, '_counts': self._counts}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def timed(self, name: str, func):
+        ''' Return: func wrapped to add its calls and wall time to the phase name '''
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+    def add(self, name: str, seconds: float, calls: int=1):
+        with self._lock:
+            phase = self._phases.setdefault(name, [0, .0])
+            phase[0] += calls
+            phase[1] += seconds
+
+    def count(self, name: str, n: int=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def merge(self, other: phaseStats):
+        for name, (calls, seconds) in other._phases.items():
+            self.add(name, seconds, calls)
+        for name, n in other._counts.items():
+            self.count(name, n)
+
+    def reset(self):
+        with self._lock:
+            self._phases.clear()
+            self._counts.clear()
+
+    def getReport(self) -> dict:
+        ''' Return:
+              dict with the calls and seconds of every phase and the counters
+        '''
+        with self._lock:
+            return {'phases': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self._phases.items()},
+                    'counts': dict(self._counts)}
+
+
+# all profiled OAS calculations of the process
+PROCESS_STATS = phaseStats()
+
+
+class spreadLadder():
+    ''' Clean price of one bond against the credit spread on one curve, for inverting price ticks
+        without a new OAS solve. The nodes carry the price and its spread derivative, between them
+        the price is the cubic Hermite interpolation. Every segment is checked at its midpoint
+        with an extra sweep and split until the interpolation error is within tolerance.
+    '''
+    def __init__(self, model: OASModel, low: float=-0.02, high: float=0.10, step: float=0.005,
+                 tolerance: float=0.001, min_step: float=1.0e-5) -> None:
+        ''' Params:
+              model: OASModel set up for the bond and the curve, e.g. by Calculate_Price
+              low, high: spread range of the ladder
+              step: initial spread step
+              tolerance: bound of the clean price error of the interpolation
+              min_step: segments are not split below this width
+        '''
+        self._tolerance = tolerance
+        self._model = model
+        n = max(int(math.ceil((high - low) / step - 1.0e-9)), 1)
+        nodes = [self._sweep(low + (high - low) * k / n) for k in range(n + 1)]
+        if any(node is None for node in nodes):
+            self._spreads = []
+            return
+
+        # split the segments until the midpoint error is within tolerance, left to right
+        spreads, prices, rhos, errors = [nodes[0][0]], [nodes[0][1]], [nodes[0][2]], []
+        pending = nodes[:0:-1]
+        while pending:
+            right = pending[-1]
+            left = (spreads[-1], prices[-1], rhos[-1])
+            mid = self._sweep(0.5 * (left[0] + right[0]))
+            if mid is None:
+                self._spreads = []
+                return
+            error = math.fabs(self._hermite(left, right, mid[0]) - mid[1])
+            if error > tolerance and right[0] - left[0] > 2.0 * min_step:
+                pending.append(mid)
+                continue
+            pending.pop()
+            spreads.append(right[0])
+            prices.append(right[1])
+            rhos.append(right[2])
+            errors.append(error)
+        self._spreads, self._prices, self._rhos, self._errors = spreads, prices, rhos, errors
+        self._model = None  # not needed for lookups, keeps the ladder small
+
+    def _sweep(self, credit_spread: float) -> tuple:
+        if self._model._price_at_spread(credit_spread) is None:
+            return None
+        return (credit_spread, self._model.get_price(), self._model.get_spread_rho())
+
+    @staticmethod
+    def _hermite(left: tuple, right: tuple, credit_spread: float) -> float:
+        h = right[0] - left[0]
+        t = (credit_spread - left[0]) / h
+        h00, h10 = (1 + 2 * t) * (1 - t) ** 2, t * (1 - t) ** 2
+        h01, h11 = t * t * (3 - 2 * t), t * t * (t - 1)
+        return h00 * left[1] + h10 * h * left[2] + h01 * right[1] + h11 * h * right[2]
+
+    @staticmethod
+    def _hermite_slope(left: tuple, right: tuple, credit_spread: float) -> float:
+        h = right[0] - left[0]
+        t = (credit_spread - left[0]) / h
+        return (6 * t * (t - 1) * (left[1] - right[1]) / h + (3 * t - 1) * (t - 1) * left[2]
+                + t * (3 * t - 2) * right[2])
+
+    def getSize(self) -> int:
+        return len(self._spreads)
+
+    def getRange(self) -> tuple:
+        ''' Return: the lowest and highest clean price of the ladder '''
+        return (self._prices[-1], self._prices[0]) if self._spreads else (math.nan, math.nan)
+
+    def getOAS(self, price: float) -> tuple:
+        ''' Invert the clean price by bisection for the segment (the price decreases in the spread)
+            and Newton iteration on its cubic, bracketed by the segment.
+            Return:
+              tuple of the spread, the price error bound of its segment and the spread error bound
+              (the price error bound over the price derivative), None if the price is outside the ladder
+        '''
+        if not self._spreads or not self._prices[-1] <= price <= self._prices[0]:
+            return None
+        lo, hi = 0, len(self._spreads) - 1
+        while hi - lo > 1:
+            k = (lo + hi) // 2
+            if self._prices[k] >= price:
+                lo = k
+            else:
+                hi = k
+        left = (self._spreads[lo], self._prices[lo], self._rhos[lo])
+        right = (self._spreads[hi], self._prices[hi], self._rhos[hi])
+
+        a, b = left[0], right[0]
+        s = a + (b - a) * (left[1] - price) / (left[1] - right[1]) if left[1] != right[1] else a
+        for _ in range(50):
+            diff = self._hermite(left, right, s) - price
+            if diff > 0:
+                a = s
+            else:
+                b = s
+            slope = self._hermite_slope(left, right, s)
+            step = -diff / slope if slope < 0 else math.inf
+            next_s = s + step if a < s + step < b else 0.5 * (a + b)
+            if math.fabs(next_s - s) < 1.0e-14:
+                break
+            s = next_s
+        rho = min(math.fabs(left[2]), math.fabs(right[2]))
+        error = self._errors[lo]
+        return s, error, error / rho if rho > 0 else math.inf
+
+
+class spreadLadderCache():
+    ''' Spread ladders by CUSIP for the current curve, a ladder is rebuilt when the curve, the
+        value date, the model type or its settings (_settings_key) or the ladder params change.
+    '''
+    def __init__(self) -> None:
+        self._ladders = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.solves = 0
+
+    def clear(self):
+        with self._lock:
+            self._ladders.clear()
+
+    def getLadder(self, bond: Bond, curve: Curve, value_date: date, model: OASModel=None, **params) -> spreadLadder:
+        ''' Return:
+              the ladder of the bond on the curve, built on a copy of model (OASModel() if None)
+              with the spreadLadder params, None if the bond cannot be priced or model is in
+              precision mode, the ladder sweeps a single tree
+        '''
+        if model is not None and model._price_precision:
+            return None
+        key = (curve.cache_key(), value_date, (model or OASModel())._settings_key(), tuple(sorted(params.items())))
+        with self._lock:
+            entry = self._ladders.get(bond.CUSIP)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+        model = copy.copy(model) if model is not None else OASModel()
+        if math.isnan(model.Calculate_Price(bond, curve, value_date, params.get('low', -0.02))):
+            ladder = None
+        else:
+            ladder = spreadLadder(model, **params)
+        with self._lock:
+            self._ladders[bond.CUSIP] = (key, ladder)
+        return ladder
+
+    def getOAS(self, bond: Bond, curve: Curve, value_date: date, price: float, credit_spread: float,
+               model: OASModel=None, **params) -> float:
+        ''' The OAS from the ladder of the bond, a full Calculate_OAS if there is no ladder, the price
+            is outside the ladder or the price error bound of its segment is above the price tolerance
+            of the model.
+            Return:
+              the implied credit spread for the market price, -1 on failure
+        '''
+        model = model or OASModel()
+        ladder = self.getLadder(bond, curve, value_date, model, **params)
+        result = ladder.getOAS(price) if ladder is not None else None
+        if result is not None and result[1] <= model._price_tolerance:
+            self.hits += 1
+            return result[0]
+        self.solves += 1
+        if result is not None:
+            credit_spread = result[0]
+        return model.Calculate_OAS(bond, curve, value_date, price, credit_spread)
+
+
+LADDER_CACHE = spreadLadderCache()
 
 
 class nodeProbability():
@@ -367,6 +1757,12 @@ class nodeProbability():
         self.prob_mid = []  #array size = 1 + 2*(j_max-1);
         self.prob_down = [] #i <----> i - j_max + 1.   
 
+        # per level probabilities including the edges, indexed by j + j_max, j=-j_max, ..., j_max
+        # at +/-j_max, up/mid/down are the probabilities of the highest/middle/lowest branch
+        self.level_up = None
+        self.level_mid = None
+        self.level_down = None
+
         # at j_max
         self.ptop_h = 0 
         self.ptop_m = 0 
@@ -442,6 +1838,76 @@ class nodeProbability():
         self.pbot_m = -1.0/3.0 - a*a*self.j_max*self.j_max*dT*dT - 2*a*(-1 * self.j_max)*dT  # 1 up
         self.pbot_l = 1 - self.pbot_h - self.pbot_m   # no rate change
 
+        # per level arrays for j=-j_max, ..., j_max, the edge levels carry the edge branching
+        self.level_up = np.array([self.pbot_h] + self.prob_up + [self.ptop_h])
+        self.level_mid = np.array([self.pbot_m] + self.prob_mid + [self.ptop_m])
+        self.level_down = np.array([self.pbot_l] + self.prob_down + [self.ptop_l])
+
+    def windowBranches(self, lo: int, hi: int, next_lo: int, next_hi: int) -> tuple:
+        ''' Branching of the levels lo..hi into the window next_lo..next_hi of the next step,
+            a branch outside of the window is moved to the nearest level in the window.
+            Return:
+              tuple of probabilities (up, mid, down) and indices (up, mid, down) into the next window
+        '''
+        j_max = self.j_max
+        mid = np.clip(np.arange(lo, hi+1), -j_max+1, j_max-1) - next_lo
+        last = next_hi - next_lo
+        return (self.level_up[lo+j_max:hi+j_max+1], self.level_mid[lo+j_max:hi+j_max+1], self.level_down[lo+j_max:hi+j_max+1],
+                np.clip(mid + 1, 0, last), np.clip(mid, 0, last), np.clip(mid - 1, 0, last))
+
+    def expectValues(self, values, size: int):
+        ''' Backward induction of the values at the next step, the expectation over the three
+            branches of every node at the current step. The last axis of values is the node axis.
+            Params:
+              values: values at the next step, levels -n..n
+              size: the number of levels on each side at the current step, n or n-1
+            Return:
+              the expected values at the current step, levels -size..size
+        '''
+        n = (values.shape[-1] - 1) // 2
+        j_max = self.j_max
+        pu, pm, pd = self.level_up[j_max-size:j_max+size+1], self.level_mid[j_max-size:j_max+size+1], self.level_down[j_max-size:j_max+size+1]
+        if n > size:
+            # the next step is one level wider on each side
+            return pu * values[..., 2:] + pm * values[..., 1:-1] + pd * values[..., :-2]
+
+        # both steps are at j_max, the edge nodes branch inwards
+        cont = np.empty(values.shape)
+        cont[..., 1:-1] = pu[1:-1] * values[..., 2:] + pm[1:-1] * values[..., 1:-1] + pd[1:-1] * values[..., :-2]
+        cont[..., -1] = pu[-1] * values[..., -1] + pm[-1] * values[..., -2] + pd[-1] * values[..., -3]
+        cont[..., 0] = pu[0] * values[..., 2] + pm[0] * values[..., 1] + pd[0] * values[..., 0]
+        return cont
+
+    def propagateQ(self, weights, size: int):
+        ''' Forward induction of the Arrow-Debreu prices to the next step.
+            Params:
+              weights: Q * one-step discount factor at the current step, levels -n..n
+              size: the number of levels on each side at the next step, n or n+1
+            Return:
+              Q at the next step, levels -size..size
+        '''
+        n = (weights.size - 1) // 2
+        j_max = self.j_max
+        q = np.zeros(2 * size + 1)
+        if size > n:
+            pu, pm, pd = self.level_up[j_max-n:j_max+n+1], self.level_mid[j_max-n:j_max+n+1], self.level_down[j_max-n:j_max+n+1]
+            q[2:] += weights * pu
+            q[1:-1] += weights * pm
+            q[:-2] += weights * pd
+        else:
+            # both steps are at j_max, the edge nodes branch inwards
+            inner = weights[1:-1]
+            q[2:] += inner * self.level_up[1:-1]
+            q[1:-1] += inner * self.level_mid[1:-1]
+            q[:-2] += inner * self.level_down[1:-1]
+            q[-1] += weights[-1] * self.ptop_h
+            q[-2] += weights[-1] * self.ptop_m
+            q[-3] += weights[-1] * self.ptop_l
+            q[2] += weights[0] * self.pbot_h
+            q[1] += weights[0] * self.pbot_m
+            q[0] += weights[0] * self.pbot_l
+        return q
+
 
 class treeBranch():
     def __init__(self, size: int=0) -> None:
@@ -860,6 +2326,18 @@ class treeBranch():
     def getNodeRate(self):
         return self.node
 
+    def getQ(self):
+        ''' Return:
+              array of the Q nodes ordered from level -size to level +size
+        '''
+        return np.array(self.qDown[::-1] + [self.qNode] + self.qUp)
+
+    def getRates(self):
+        ''' Return:
+              array of the rates ordered from level -size to level +size
+        '''
+        return np.array(self.down[::-1] + [self.node] + self.up)
+
     def getUpRate(self, index: int):
         return self.up[index]
 
@@ -0,0 +1,151 @@
+from __future__ import annotations
+import math
+import numpy as np
+from scipy.linalg import solve_banded
+from curve import Curve
+from oas import OASModel, calibratedTree, phaseStats
+import utilities
+
+
+class PDEModel(OASModel):
+    ''' Finite difference alternative to the trinomial tree with the same interface and schedules.
+        The rate at x is m(t) * exp(x), x follows dx = -a x dt + vol dW as the levels of the tree,
+        and the values are rolled back by Crank-Nicolson on a fixed x grid, see pdeGrid.
+    '''
+    def __init__(self) -> None:
+        super().__init__()
+        self._num_nodes = 201  # nodes of the x grid, odd so that x = 0 is a node
+        self._num_std = 5.0  # half width of the x grid in standard deviations of x at maturity
+
+    def _settings_key(self) -> tuple:
+        return super()._settings_key() + (self._num_nodes, self._num_std)
+
+    def _set_rate_tree(self):
+        ''' Calibrate the x grid to the curve over the steps of _times
+            Return:
+              0 on success, -1 otherwise
+        '''
+        if self._numT < 0:
+            return -1
+        grid = pdeGrid(self._curve, self._times, self._num_nodes, self._num_std)
+        self._calibratedTree = grid
+        self._gridTree = grid
+        return grid.extend(self._numT, self._stats)
+
+    def _get_sweep_tree(self):
+        ''' Return: the x grid, rolled back by Crank-Nicolson in the sweep of OASModel '''
+        return self._calibratedTree
+
+    def Calculate_Prices(self, bonds: list, curve: Curve, value_date, credit_spreads) -> list:
+        raise ValueError("Stacked valuation needs the trinomial tree")
+
+
+class pdeGrid(calibratedTree):
+    ''' Crank-Nicolson discretization on a fixed x grid, calibrated to the curve as the tree.
+        A step applies the diffusion of x over dt (expect, a tridiagonal solve) and then discounts
+        at the node rates, so Q is carried forward by the transposed step (propagate) and the
+        multiplier of every step solves the same equation as in calibratedTree.extend.
+    '''
+    def __init__(self, curve: Curve, times, num_nodes: int=201, num_std: float=5.0) -> None:
+        self._curve = curve
+        self._times = times
+        self._a = curve._mean_reversion
+        self._vol = curve._ir_vol
+        self._data = np.empty((self.ROWS, 0))
+        self._offsets = [0]
+        self._multiplier = 0
+        self._windows = {}
+
+        numT = len(times) - 1
+        self._dts = np.diff(times) if numT > 0 else np.full(1, 1.0 / 365.25)
+        horizon = max(times[-1], self._dts[0])
+        std = self._vol * math.sqrt(-math.expm1(-2.0 * self._a * horizon) / (2.0 * self._a))
+        half = num_nodes // 2
+        self._x = np.linspace(-num_std * std, num_std * std, 2 * half + 1)
+        self._dx = self._x[1] - self._x[0]
+        self._base = np.exp(self._x)
+
+        # generator of x, central differences inside, one-sided drift and no diffusion at the edges
+        drift = -self._a * self._x
+        diffusion = 0.5 * self._vol * self._vol / (self._dx * self._dx)
+        self._lower = diffusion - drift / (2.0 * self._dx)
+        self._diag = np.full(self._x.size, -2.0 * diffusion)
+        self._upper = diffusion + drift / (2.0 * self._dx)
+        self._lower[0], self._diag[0], self._upper[0] = 0.0, -drift[0] / self._dx, drift[0] / self._dx
+        self._lower[-1], self._diag[-1], self._upper[-1] = -drift[-1] / self._dx, drift[-1] / self._dx, 0.0
+        self._operators = {}  # banded (I - dt/2 M) and its transpose by dt
+
+    def _operator(self, dt: float) -> tuple:
+        op = self._operators.get(dt)
+        if op is None:
+            n = self._x.size
+            a = np.zeros((3, n))
+            a[0, 1:] = -0.5 * dt * self._upper[:-1]
+            a[1] = 1.0 - 0.5 * dt * self._diag
+            a[2, :-1] = -0.5 * dt * self._lower[1:]
+            at = np.zeros((3, n))
+            at[0, 1:] = a[2, :-1]
+            at[1] = a[1]
+            at[2, :-1] = a[0, 1:]
+            op = self._operators[dt] = (a, at)
+        return op
+
+    def _explicit(self, dt: float, values, transpose: bool=False):
+        ''' (I + dt/2 M) values, or its transpose, on the last axis '''
+        h = 0.5 * dt
+        out = values * (1.0 + h * self._diag)
+        if not transpose:
+            out[..., :-1] += h * self._upper[:-1] * values[..., 1:]
+            out[..., 1:] += h * self._lower[1:] * values[..., :-1]
+        else:
+            out[..., 1:] += h * self._upper[:-1] * values[..., :-1]
+            out[..., :-1] += h * self._lower[1:] * values[..., 1:]
+        return out
+
+    def getDt(self, i: int) -> float:
+        return self._dts[i] if i < len(self._dts) else self._dts[-1]
+
+    def getBase(self, i: int):
+        return self._base
+
+    def getCalibrationTime(self, i: int) -> float:
+        return self._times[i] + self.getDt(i)
+
+    def expect(self, i: int, values):
+        ''' Crank-Nicolson step of the values at step i+1 back to step i '''
+        dt = self.getDt(i)
+        a, _ = self._operator(dt)
+        rhs = self._explicit(dt, values)
+        return solve_banded((1, 1), a, rhs.T, check_finite=False).T
+
+    def propagate(self, i: int, weights):
+        ''' the transpose of expect, Q forward from step i to step i+1 '''
+        dt = self.getDt(i)
+        _, at = self._operator(dt)
+        return self._explicit(dt, solve_banded((1, 1), at, weights, check_finite=False), transpose=True)
+
+    def extend(self, numT: int, stats: phaseStats=None) -> int:
+        ''' Calibrate by forward induction of Q up to step numT, see calibratedTree.extend
+            Return:
+              0 on success, -1 otherwise
+        '''
+        solve = self._solve_multiplier if stats is None else stats.timed('_solve_multiplier', self._solve_multiplier)
+        numT = min(numT, len(self._times) - 1)
+        today = utilities.toDateNumber(self._curve._valueDate)
+        first = self.getNumT() + 1
+        dFs = self._curve.getDiscountFactors(today + np.array([self.getCalibrationTime(i) for i in range(first, numT+1)]) * 365.25)
+        for i in range(first, numT+1):
+            if i == 0:
+                q = np.zeros(self._x.size)
+                q[self._x.size // 2] = 1.0
+            else:
+                q = self.propagate(i-1, self.getQ(i-1) * np.exp(-self.getRates(i-1) * self.getDt(i-1)))
+            dF = dFs[i - first]
+
+            multiplier = solve(q, self._base * self.getDt(i), dF, self._multiplier)
+            if multiplier < 0:
+                print("cannot find multiplier")
+                return -1
+            self._multiplier = multiplier
+            self._append(multiplier * self._base, q)
+        return 0
@@ -0,0 +1,168 @@
+import os
+import copy
+import math
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import numpy as np
+import pandas as pd
+from curve import Curve, SvenssonCurve
+from oas import OASModel
+
+
+class Scenario():
+    ''' A stress scenario, a shock of the spot curve and of the OAS.
+        The curve shock of a point with tenor t years (rates are semi-annual compounded) is
+          rate * (1 + rate_scale) + rate_shift + twist * (t - twist_pivot) + tenor_shifts[t]
+        and the OAS is shocked to oas + spread_scale * |oas| + spread_shift, so a positive scale
+        widens a negative OAS as well.
+        A SvenssonCurve is refitted to its shocked points.
+    '''
+    def __init__(self, name: str, rate_shift: float=.0, rate_scale: float=.0, twist: float=.0,
+                 twist_pivot: float=5.0, tenor_shifts: dict=None, spread_shift: float=.0,
+                 spread_scale: float=.0) -> None:
+        self.name = name
+        self.rate_shift = rate_shift
+        self.rate_scale = rate_scale
+        self.twist = twist  # shift per year of tenor, steepening if positive
+        self.twist_pivot = twist_pivot
+        self.tenor_shifts = tenor_shifts or {}  # tenor in years: shift, applied to the nearest curve point
+        self.spread_shift = spread_shift
+        self.spread_scale = spread_scale
+
+    def __str__(self) -> str:
+        return self.name
+
+    def isSpreadOnly(self) -> bool:
+        return not (self.rate_shift or self.rate_scale or self.twist or any(self.tenor_shifts.values()))
+
+    def shockCurve(self, curve: Curve) -> Curve:
+        ''' Return:
+              a shocked copy of the curve, the curve itself for a spread only scenario
+        '''
+        if self.isSpreadOnly():
+            return curve
+        tenors = [(d[2] - curve._valueDateNum) / 365.25 for d in curve._data]
+        extra = [.0] * len(tenors)
+        for tenor, shift in self.tenor_shifts.items():
+            k = min(range(len(tenors)), key=lambda i: math.fabs(tenors[i] - tenor))
+            extra[k] += shift
+
+        rates = [rate * (1.0 + self.rate_scale) + self.rate_shift + self.twist * (tenor - self.twist_pivot) + shift
+                 for (_, rate, _), tenor, shift in zip(curve._data, tenors, extra)]
+        if isinstance(curve, SvenssonCurve):
+            # refit to the shocked points
+            shocked = SvenssonCurve.fit(curve._valueDate, [d[0] for d in curve._data], rates)
+            shocked._compoundFreq, shocked._ir_vol, shocked._mean_reversion = \
+                curve._compoundFreq, curve._ir_vol, curve._mean_reversion
+            return shocked
+        shocked = copy.copy(curve)
+        shocked._data = []
+        for (rate_date, _, _), rate in zip(curve._data, rates):
+            shocked.append_data(rate, rate_date)
+        return shocked
+
+    def shockSpread(self, credit_spread: float) -> float:
+        return credit_spread + self.spread_scale * math.fabs(credit_spread) + self.spread_shift
+
+
+# The scenarios of the README
+README_SCENARIOS = [
+    Scenario('Interest Rate Up 5%', rate_scale=0.05),
+    Scenario('Interest Rate Up 25%', rate_scale=0.25),
+    Scenario('Interest Rate Down 5%', rate_scale=-0.05),
+    Scenario('Interest Rate Down 25%', rate_scale=-0.25),
+    Scenario('Credit Spread Tighten 5%', spread_scale=-0.05),
+    Scenario('Credit Spread Widen 5%', spread_scale=0.05),
+]
+
+# the base curve and the shocked curves of the worker process, set once by _init_worker
+_worker_curve = None
+_worker_curves = None
+
+
+def _init_worker(curve: Curve, curves: list) -> None:
+    global _worker_curve, _worker_curves
+    _worker_curve = curve
+    _worker_curves = curves
+
+
+def _scenario_task(task: tuple) -> dict:
+    ''' Solve the OAS of one bond on the base curve and revalue it under every scenario at the
+        shocked OAS. Spread only scenarios take one sweep of the base tree, curve scenarios are
+        priced on the tree of the shocked curve, calibrated once per worker by the tree cache.
+    '''
+    bond, value_date, price, credit_spread, scenarios = task
+    result = {'CUSIP': bond.CUSIP, 'Price': price, 'OAS': None, 'Error': None}
+    for scenario in scenarios:
+        result[scenario.name] = math.nan
+    try:
+        if bond._coupon_schedule is None:
+            bond.calculate_coupon_schedule()
+        model = OASModel()
+        oas = model.Calculate_OAS(bond, _worker_curve, value_date, price, credit_spread)
+        if oas == -1 or oas is None or math.isnan(oas):
+            result['Error'] = 'OAS calculation failed'
+            return result
+        result['OAS'] = oas
+
+        for scenario, curve in zip(scenarios, _worker_curves):
+            spread = scenario.shockSpread(oas)
+            if curve is None:
+                if model._price_at_spread(spread) is not None:
+                    result[scenario.name] = model.get_price()
+            else:
+                result[scenario.name] = OASModel().Calculate_Price(bond, curve, value_date, spread)
+        # leave the base model at its OAS
+        model._price_at_spread(oas)
+    except Exception as e:
+        result['Error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def run_scenarios(bonds: list, value_date: date, scenarios: list=None, prices: list=None, curve: Curve=None,
+                  curve_csv: str=None, credit_spread=0.01, max_workers: int=None) -> pd.DataFrame:
+    ''' Revalue a list of bonds under a set of scenarios in parallel on a process pool, holding
+        the OAS implied by the market price (shocked by the spread shock of the scenario).
+        The curves are shocked once and sent to every worker when it starts.
+        Return:
+          DataFrame with one row per bond, in the order of the bonds, the columns CUSIP, Price,
+          OAS and Error of the base and the clean price under every scenario (nan on failure)
+        Params:
+          bonds: list of Bond, e.g. Bond.load_all_bonds()
+          value_date: pricing date (settlement date)
+          scenarios: list of Scenario, README_SCENARIOS if None
+          prices: market prices, the bonds' ask prices if None
+          curve: the spot Curve, loaded from curve_csv for value_date if None
+          curve_csv: spot curve file, ./data/treasuryspotcurve.csv if None
+          credit_spread: seed of the OAS solver, one for all bonds or a list or array with one per bond
+          max_workers: number of processes, os.cpu_count() if None
+    '''
+    scenarios = scenarios or README_SCENARIOS
+    if len(set(s.name for s in scenarios)) != len(scenarios):
+        raise ValueError("Scenario names are not unique")
+    if curve is None:
+        curve = Curve(value_date)
+        curve.load_from_csv(curve_csv or './data/treasuryspotcurve.csv')
+    if prices is None:
+        prices = [bond._market_price for bond in bonds]
+    if len(prices) != len(bonds):
+        raise ValueError(f"{len(bonds)} bonds but {len(prices)} prices")
+    # None for a spread only scenario, priced on the base tree
+    curves = [None if s.isSpreadOnly() else s.shockCurve(curve) for s in scenarios]
+
+    if not isinstance(credit_spread, (list, tuple, np.ndarray)):
+        credit_spread = [credit_spread] * len(bonds)
+    if len(credit_spread) != len(bonds):
+        raise ValueError(f"{len(bonds)} bonds but {len(credit_spread)} credit spreads")
+    tasks = [(bond, value_date, price, seed, scenarios) for bond, price, seed in zip(bonds, prices, credit_spread)]
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(tasks) <= 1:
+        _init_worker(curve, curves)
+        results = [_scenario_task(task) for task in tasks]
+    else:
+        chunksize = max(1, len(tasks) // (4 * max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(curve, curves)) as executor:
+            results = list(executor.map(_scenario_task, tasks, chunksize=chunksize))
+
+    columns = ['CUSIP', 'Price', 'OAS', 'Error'] + [s.name for s in scenarios]
+    return pd.DataFrame(results, columns=columns)
@@ -4,8 +4,10 @@ sys.path.insert(0, '..')
 from datetime import datetime
 from flask import Flask, request, jsonify
 from bond import Bond
-from curve import Curve
+from curve import CurveStore
 from oas import OASModel
+from pde import PDEModel
+from montecarlo import MCModel
 from yieldcalculator import YieldCalculator
 
 app = Flask(__name__)
@@ -40,14 +42,14 @@ def pricing():
     if not bond:
         return f"Bond not found with cusip {cusip}"
     
-    spot_curve = Curve(valueDate)
-    spot_curve.load_from_csv('../data/treasuryspotcurve.csv')
-    if not spot_curve:
+    try:
+        spot_curve = CurveStore.from_csv('../data/treasuryspotcurve.csv').getCurve(valueDate)
+    except Exception:
         return f"Cannot find spot curve for {valueDate}"
     
-    par_curve = Curve(valueDate)
-    par_curve.load_from_csv('../data/treasuryparcurve.csv')
-    if not par_curve:
+    try:
+        par_curve = CurveStore.from_csv('../data/treasuryparcurve.csv').getCurve(valueDate)
+    except Exception:
         return f"Cannot find par curve for {valueDate}"
 
     bond.calculate_coupon_schedule()
@@ -57,7 +59,8 @@ def pricing():
     tenor, trsy_yield = YieldCalculator.get_yield_spread(bond, ytm, par_curve, interpolate=False)
     spread = request.args.get('oas') or bond.Cpn
     spread = float(spread)
-    oas = OASModel().Calculate_OAS(bond, spot_curve, valueDate, price, spread)
+    model = {'pde': PDEModel, 'mc': MCModel}.get(request.args.get('engine'), OASModel)()
+    oas = model.Calculate_OAS(bond, spot_curve, valueDate, price, spread)
     print(bond, bond._market_price, ytm, ytc, ytw[0], tenor, trsy_yield, ytm - trsy_yield)
     result = {'CUSIP': bond.CUSIP,
               'Coupon': bond.Cpn,
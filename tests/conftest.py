@@ -0,0 +1,39 @@
+import os
+import sys
+from datetime import date
+import pytest
+from dateutil.relativedelta import relativedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bond import Bond  # noqa: E402
+from curve import Curve  # noqa: E402
+
+VALUE_DATE = date(2021, 3, 19)
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    ''' the modules read ./data relative to the repository '''
+    monkeypatch.chdir(ROOT)
+
+
+def make_flat_curve(rate: float=0.03, slope: float=0.002, value_date: date=VALUE_DATE) -> Curve:
+    ''' a curve of whole year points from 1 to 30 years, rate + slope * years '''
+    curve = Curve(value_date)
+    for year in range(1, 31):
+        curve.append_data(rate + slope * year, value_date + relativedelta(years=year))
+    curve._numRate = len(curve._data)
+    return curve
+
+
+@pytest.fixture
+def flat_curve() -> Curve:
+    return make_flat_curve()
+
+
+def load_bond(cusip: str) -> Bond:
+    bond = Bond.load_by_cusip(cusip, csv=os.path.join(ROOT, 'data', 'bonds.csv'))
+    bond.calculate_coupon_schedule()
+    return bond
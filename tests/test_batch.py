@@ -0,0 +1,22 @@
+import numpy as np
+from batch import calculate_oas
+from conftest import VALUE_DATE, load_bond
+from oas import OASModel
+
+
+def test_batch_matches_single_bond_oas(flat_curve):
+    bonds = [load_bond(cusip) for cusip in ('459200HU8', '459200GS4')]
+    results = calculate_oas(bonds, VALUE_DATE, curve=flat_curve, max_workers=1, profile=True)
+    for bond, result in zip(bonds, results):
+        assert result['Error'] is None and result['CUSIP'] == bond.CUSIP
+        assert result['OAS'] == OASModel().Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+        assert result['Stats'].getReport()['counts']['Calculate_OAS'] == 1
+
+
+def test_batch_takes_an_array_of_seeds(flat_curve):
+    bonds = [load_bond(cusip) for cusip in ('459200HU8', '459200GS4')]
+    seeds = np.array([0.005, -0.005])
+    results = calculate_oas(bonds, VALUE_DATE, curve=flat_curve, credit_spread=seeds, max_workers=1)
+    for bond, seed, result in zip(bonds, seeds, results):
+        assert result['Error'] is None
+        assert result['OAS'] == OASModel().Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, seed)
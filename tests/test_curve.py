@@ -0,0 +1,153 @@
+import math
+import os
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+import pytest
+from dateutil.relativedelta import relativedelta
+from curve import Curve, CurveStore, TreasuryCurveCache
+from utilities import DCToCC
+
+PAR_CSV = os.path.join('data', 'treasuryparcurve.csv')
+SPOT_CSV = os.path.join('data', 'treasuryspotcurve.csv')
+
+
+def _fixture_fetcher(calls: list):
+    def fetch(url: str) -> str:
+        calls.append(url)
+        with open(PAR_CSV) as f:
+            return f.read()
+    return fetch
+
+
+def test_download_cache_offline(tmp_path):
+    calls = []
+    cache = TreasuryCurveCache(str(tmp_path), fetcher=_fixture_fetcher(calls), url='{yearmonth}')
+    curve = Curve(date(2023, 8, 18))
+    curve.download_curve(cache)
+    assert curve._numRate == 13 and calls == ['202308']
+    Curve(date(2023, 8, 17)).download_curve(cache)
+    assert len(calls) == 1
+
+    offline = TreasuryCurveCache(str(tmp_path), offline=True)
+    curve = Curve(date(2023, 8, 18))
+    curve.download_curve(offline)
+    assert curve._numRate == 13
+    try:
+        Curve(date(2023, 7, 3)).download_curve(offline)
+        assert False, "offline cache downloaded a missing month"
+    except Exception as e:
+        assert 'offline' in str(e)
+
+
+def test_download_cache_refetches_partial_past_month(tmp_path):
+    calls = []
+    cache = TreasuryCurveCache(str(tmp_path), fetcher=_fixture_fetcher(calls), url='{yearmonth}')
+    cache.prefetch(date(2023, 8, 1), date(2023, 8, 31))
+    assert calls == ['202308']
+    path = cache.getPath('202308')
+
+    # written during the month: partial, downloaded again
+    mid_month = datetime(2023, 8, 15).timestamp()
+    os.utime(path, (mid_month, mid_month))
+    assert cache.prefetch(date(2023, 8, 1), date(2023, 8, 31)) == ['202308']
+
+    # written after the month ended: final
+    after = datetime(2023, 9, 2).timestamp()
+    os.utime(path, (after, after))
+    assert cache.prefetch(date(2023, 8, 1), date(2023, 8, 31)) == []
+
+
+def _pandas_points(csv: str, value_date: date) -> list:
+    # the per-call filter CurveStore replaced
+    df = pd.read_csv(csv)
+    df['Date'] = pd.to_datetime(df['Date']).dt.date
+    row = df[df['Date'] == value_date].reset_index(drop=True)
+    points = []
+    for col in row.columns[1:]:
+        if 'Mo' in col:
+            rate_date = value_date + relativedelta(months=int(col.split(' ')[0]))
+        elif 'Yr' in col:
+            rate_date = value_date + relativedelta(years=int(col.split(' ')[0]))
+        else:
+            rate_date = value_date + relativedelta(years=int(col[-2:]))
+        points.append((rate_date, float(row.loc[0, col]) / 100))
+    return points
+
+
+def test_store_matches_pandas_filter():
+    for csv, value_date in [(PAR_CSV, date(2023, 8, 11)), (SPOT_CSV, date(2023, 8, 11)), (SPOT_CSV, date(1990, 1, 2))]:
+        store = CurveStore.from_csv(csv)
+        assert CurveStore.from_csv(csv) is store
+        curve = store.getCurve(value_date)
+        assert store.getCurve(value_date) is curve
+        expected = _pandas_points(csv, value_date)
+        assert [d[0] for d in curve._data] == [d[0] for d in expected]
+        assert np.allclose([d[1] for d in curve._data], [d[1] for d in expected], equal_nan=True)
+    with pytest.raises(Exception, match='No data found'):
+        CurveStore.from_csv(PAR_CSV).getCurve(date(2023, 8, 12))
+
+
+def test_batched_rates_match_the_scalar_lookup():
+    curve = CurveStore.from_csv(PAR_CSV).getCurve(date(2023, 8, 11))
+    first, last = curve._data[0][2], curve._data[-1][2]
+    # before, on and between the points, and past the last
+    days = np.concatenate([np.linspace(curve._valueDateNum, last + 400, 2001), [d[2] for d in curve._data], [first - 1]])
+    for interpolate in [False, True]:
+        rates = curve.getRates(days, interpolate)
+        # the interpolation differs from the scalar one in rounding only
+        assert np.allclose(rates, [curve.getTheRate(d, interpolate) for d in days], rtol=1.0e-15, atol=0.0)
+        t = (days - curve._valueDateNum) / 365.25
+        expected = [math.exp(-DCToCC(curve.getTheRate(d, interpolate), 2) * s) for d, s in zip(days, t)]
+        assert np.allclose(curve.getDiscountFactors(days, interpolate), expected, rtol=1.0e-13, atol=0.0)
+
+
+def test_archive_matches_csv(tmp_path):
+    path = str(tmp_path / 'spot.curves')
+    csv_store = CurveStore.from_csv(SPOT_CSV)
+    archive = CurveStore.convert(SPOT_CSV, path)
+    assert CurveStore.is_archive(path) and not CurveStore.is_archive(SPOT_CSV)
+    assert np.array_equal(np.asarray(archive._days), csv_store._days)
+    assert np.allclose(np.asarray(archive._rates), csv_store._rates, equal_nan=True)
+    for value_date in [date(2023, 8, 11), date(2021, 3, 19), date(1990, 1, 2)]:
+        a, b = Curve(value_date), Curve(value_date)
+        a.load_from_csv(path)
+        b.load_from_csv(SPOT_CSV)
+        assert [d[0] for d in a._data] == [d[0] for d in b._data]
+        assert np.allclose([d[1] for d in a._data], [d[1] for d in b._data], equal_nan=True)
+
+
+def test_archive_rewrite_keeps_readers_mapped(tmp_path):
+    path = str(tmp_path / 'par.curves')
+    store = CurveStore.convert(PAR_CSV, path)
+    days = np.asarray(store._days).copy()
+    # rewrite while store has the file mapped, it is replaced, not truncated in place
+    CurveStore.read_csv(SPOT_CSV).save_archive(path)
+    assert np.array_equal(np.asarray(store._days), days)
+    assert CurveStore.from_csv(path) is not store
+    assert len(CurveStore.from_csv(path)._days) > len(days)
+    assert [p.name for p in tmp_path.iterdir()] == ['par.curves']
+
+
+def test_svensson_fit_reproduces_the_table():
+    store = CurveStore.from_csv(SPOT_CSV)
+    for value_date in [date(2023, 8, 11), date(1990, 1, 2), date(1975, 6, 2)]:
+        points = store.getCurve(value_date)._data
+        params = store.getSvensson(value_date)
+        assert params.shape == (6,) and store.getSvensson(value_date) is params
+        curve = store.getSvenssonCurve(value_date)
+        assert '_data' not in curve.__dict__
+        finite = [d for d in points if np.isfinite(d[1])]
+        fitted = curve.getRates([d[2] for d in finite])
+        assert np.abs(fitted - [d[1] for d in finite]).max() < 1.0e-5
+
+    dates, history = store.fitSvensson(date(2023, 8, 1), date(2023, 8, 11))
+    assert history.shape == (len(dates), 6) and np.all(np.isfinite(history))
+
+
+def test_svensson_weights_are_exact_for_whole_years():
+    curve = CurveStore.from_csv(SPOT_CSV).getSvenssonCurve(date(2023, 8, 11))
+    points = curve.get_curve_data()
+    weights = dict(curve.getRateWeights(points[6][2]))
+    assert abs(sum(weights.values()) - 1.0) < 1.0e-12
+    assert abs(sum(w * points[k][1] for k, w in weights.items()) - points[6][1]) < 1.0e-12
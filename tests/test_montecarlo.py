@@ -0,0 +1,47 @@
+import math
+import montecarlo
+from conftest import VALUE_DATE, load_bond
+from montecarlo import MCModel
+from oas import OASModel
+
+CALLABLE = '459200KY6'
+
+
+def mc_model(**attrs) -> MCModel:
+    model = MCModel()
+    model._num_paths = 4000
+    model._chunk_size = 1000
+    model._num_calibration_paths = 20000
+    model._num_regression_paths = 4000
+    for name, value in attrs.items():
+        setattr(model, name, value)
+    return model
+
+
+def test_mc_price_matches_tree(flat_curve):
+    bond = load_bond(CALLABLE)
+    tree = OASModel()
+    tree._yearly_time_step = 24
+    price = tree.Calculate_Price(bond, flat_curve, VALUE_DATE, 0.0)
+    model = mc_model()
+    mc = model.Calculate_Price(bond, flat_curve, VALUE_DATE, 0.0)
+    assert math.fabs(mc - price) < 3.0 * model.get_standard_error() + 0.05
+
+
+def test_mc_pool_is_started_once_per_call(flat_curve, monkeypatch):
+    pools = []
+
+    class CountingPool(montecarlo.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(montecarlo, 'ProcessPoolExecutor', CountingPool)
+    bond = load_bond(CALLABLE)
+    single = mc_model()
+    oas = single.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    assert not pools and single._num_sweeps > 1
+
+    parallel = mc_model(_max_workers=2)
+    assert parallel.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01) == oas
+    assert len(pools) == 1 and parallel._executor is None
@@ -0,0 +1,306 @@
+import copy
+import math
+import os
+import pickle
+import warnings
+from datetime import date
+import numpy as np
+import pytest
+from conftest import VALUE_DATE, load_bond, make_flat_curve
+from curve import CurveStore, SvenssonCurve
+from oas import OASModel, calibratedTree, rateTreeCache, spreadLadderCache, timeGrid
+
+CALLABLE = '459200KY6'
+BULLET = '459200HU8'
+SPOT_CSV = os.path.join('data', 'treasuryspotcurve.csv')
+
+
+def tree_model(steps: int=24, **attrs) -> OASModel:
+    model = OASModel()
+    model._yearly_time_step = steps
+    for name, value in attrs.items():
+        setattr(model, name, value)
+    return model
+
+
+def test_profiling_counts_phases(flat_curve):
+    bond = load_bond(CALLABLE)
+    oas = tree_model().Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    model = tree_model(_profile=True)
+    assert model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01) == oas
+    report = model.get_stats().getReport()
+    assert report['phases']['_calculate_values']['calls'] == report['counts']['solver_iterations']
+    assert report['phases']['_set_rate_tree']['calls'] == 1
+
+    model._profile = False
+    model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    assert model.get_stats() is None and '_calculate_values' not in model.__dict__
+
+
+def test_profiled_model_builds_ladder(flat_curve):
+    bond = load_bond(CALLABLE)
+    ladders = []
+    for profile in (False, True):
+        model = tree_model(_profile=profile)
+        model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+        ladders.append(spreadLadderCache().getLadder(bond, flat_curve, VALUE_DATE, model))
+    plain, profiled = ladders
+    low, high = plain.getRange()
+    assert high - low > 10.0
+    assert profiled.getRange() == plain.getRange()
+    price = 0.5 * (low + high)
+    assert profiled.getOAS(price) is not None
+    assert math.isclose(profiled.getOAS(price)[0], plain.getOAS(price)[0], abs_tol=1.0e-12)
+
+
+def test_stacked_prices_match_single_bond_prices(flat_curve):
+    bonds = [load_bond(cusip) for cusip in (CALLABLE, BULLET, '459200KX8', '459200GS4')]
+    spreads = [0.01, 0.005, -0.002, 0.0]
+    for steps, use_closed_form in ((24, True), (24, False), (12, False)):
+        stacked = tree_model(steps, _use_closed_form=use_closed_form).Calculate_Prices(bonds, flat_curve, VALUE_DATE, spreads)
+        single = [tree_model(steps, _use_closed_form=use_closed_form).Calculate_Price(bond, flat_curve, VALUE_DATE, s)
+                  for bond, s in zip(bonds, spreads)]
+        assert stacked == single
+    for attrs in ({'_prune_threshold': 1.0e-4}, {'_time_grid': timeGrid()}):
+        with pytest.raises(ValueError):
+            tree_model(**attrs).Calculate_Prices(bonds, flat_curve, VALUE_DATE, spreads)
+
+
+def test_closed_form_reprices_its_oas(flat_curve):
+    bond = load_bond(BULLET)
+    model = tree_model()
+    oas = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01, tolerance=1.0e-8)
+    assert model._closed_form
+    price = tree_model().Calculate_Prices([bond], flat_curve, VALUE_DATE, oas)[0]
+    assert price == model.get_price()
+    assert math.isclose(price, bond._market_price, abs_tol=1.0e-6)
+
+
+def test_ladder_cache_keys_on_model_settings(flat_curve):
+    from pde import PDEModel
+    bond = load_bond(CALLABLE)
+    cache = spreadLadderCache()
+    ladder = cache.getLadder(bond, flat_curve, VALUE_DATE, tree_model())
+    assert cache.getLadder(bond, flat_curve, VALUE_DATE, tree_model()) is ladder
+    coarse = cache.getLadder(bond, flat_curve, VALUE_DATE, tree_model(12))
+    assert coarse is not ladder and coarse.getRange() != ladder.getRange()
+    pde = PDEModel()
+    pde._yearly_time_step = 24
+    assert cache.getLadder(bond, flat_curve, VALUE_DATE, pde) is not coarse
+
+
+def test_tolerance_argument_is_per_call(flat_curve):
+    bond = load_bond(CALLABLE)
+    model = tree_model()
+    oas = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    tight = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01, tolerance=1.0e-9)
+    assert math.fabs(model.get_price() - bond._market_price) <= 1.0e-9
+    assert model._price_tolerance == 0.01
+    assert model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01) == oas != tight
+
+
+def _bumped(curve, k: int, shift: float):
+    bumped = copy.copy(curve)
+    bumped._data = list(curve._data)
+    rate_date, rate, day = bumped._data[k]
+    bumped._data[k] = (rate_date, rate + shift, day)
+    return bumped
+
+
+def test_key_rate_sensitivities_match_finite_differences(flat_curve):
+    bond = load_bond(CALLABLE)
+    model = tree_model()
+    oas = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        krd = model.Calculate_Key_Rate_Durations()
+    sensitivities = krd['sensitivities']
+    assert len(sensitivities) == flat_curve._numRate
+    h = 1.0e-6
+    for k in (0, 2, 5, 9, 11):
+        up = tree_model().Calculate_Price(bond, _bumped(flat_curve, k, h), VALUE_DATE, oas)
+        down = tree_model().Calculate_Price(bond, _bumped(flat_curve, k, -h), VALUE_DATE, oas)
+        assert math.isclose(sensitivities[k], (up - down) / (2 * h), rel_tol=1.0e-3, abs_tol=1.0e-3)
+    # points beyond the maturity do not move the price
+    assert np.all(np.asarray(sensitivities[14:]) == 0)
+
+
+def test_key_rate_durations_without_overflow_on_daily_tree():
+    value_date = date(2023, 8, 11)
+    curve = CurveStore.from_csv(SPOT_CSV).getSvenssonCurve(value_date)
+    bond = load_bond(CALLABLE)
+    model = OASModel()
+    assert model.Calculate_OAS(bond, curve, value_date, bond._market_price, 0.01) != -1
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        krd = model.Calculate_Key_Rate_Durations()
+    assert np.all(np.isfinite(krd['key_rate_durations']))
+
+
+def test_flat_svensson_curve_prices_as_flat_curve():
+    flat = make_flat_curve(0.04, 0.0)
+    svensson = SvenssonCurve(VALUE_DATE, [0.04, 0.0, 0.0, 0.0, 1.0, 2.0])
+    bond = load_bond(CALLABLE)
+    oas = tree_model().Calculate_OAS(bond, flat, VALUE_DATE, bond._market_price, 0.01)
+    assert oas != -1
+    assert math.isclose(tree_model().Calculate_OAS(bond, svensson, VALUE_DATE, bond._market_price, 0.01),
+                        oas, abs_tol=1.0e-12)
+
+
+def test_scenario_refits_svensson_curve():
+    from scenario import Scenario
+    curve = CurveStore.from_csv(SPOT_CSV).getSvenssonCurve(date(2023, 8, 11))
+    shocked = Scenario('up', rate_shift=0.01).shockCurve(curve)
+    assert isinstance(shocked, SvenssonCurve)
+    day = curve._valueDateNum + 3652.5
+    assert math.isclose(shocked.getTheRate(day) - curve.getTheRate(day), 0.01, abs_tol=1.0e-8)
+
+
+def test_tree_converges_to_closed_form(flat_curve):
+    bond = load_bond(BULLET)
+    closed = tree_model().Calculate_Price(bond, flat_curve, VALUE_DATE, 0.005)
+    tree = tree_model(100, _use_closed_form=False).Calculate_Price(bond, flat_curve, VALUE_DATE, 0.005)
+    assert math.isclose(tree, closed, abs_tol=0.02)
+
+
+def test_sweep_matches_node_by_node_loop(flat_curve):
+    for cusip in (CALLABLE, BULLET):
+        for credit_spread in (0.0, 0.01):
+            model = tree_model(_use_closed_form=False)
+            assert model._setup(load_bond(cusip), flat_curve, VALUE_DATE, credit_spread) == 0
+            assert model._calculate_values() == 0
+            price = model.get_dirty_price()
+            model._set_rate_tree_loop()
+            model._set_credit_spread_to_rate_tree()
+            assert model._calculate_values_loop() == 0
+            # the loop calibrates by bisection to 1e-5 in the multiplier
+            assert math.isclose(model.get_dirty_price(), price, abs_tol=1.0e-4)
+
+
+def test_calibrated_q_reprices_the_curve(flat_curve):
+    tree = calibratedTree(flat_curve, 24)
+    assert tree.extend(120) == 0
+    today = flat_curve._valueDateNum
+    for i in (1, 10, 60, 120):
+        discount = flat_curve.getDiscountFactors([today + i / 24 * 365.25])[0]
+        assert math.isclose(tree.getQ(i).sum(), discount, rel_tol=1.0e-12)
+
+
+def test_calibration_matches_node_by_node_loop(flat_curve):
+    model = tree_model(_use_closed_form=False)
+    assert model._setup(load_bond(CALLABLE), flat_curve, VALUE_DATE, 0.0) == 0
+    model._set_rate_tree_loop()
+    assert len(model._rateTree) == model._numT + 1
+    for i, branch in enumerate(model._rateTree):
+        # the loop solves the multiplier by bisection to 1e-5
+        assert np.allclose(branch.getRates(), model._calibratedTree.getRates(i), rtol=2.0e-3, atol=0.0)
+        assert np.allclose(branch.getQ(), model._calibratedTree.getQ(i), rtol=0.0, atol=1.0e-6)
+
+
+def test_tree_cache_reuses_calibrated_trees(flat_curve):
+    cache = rateTreeCache()
+    tree = cache.getTree(flat_curve, 24, 100)
+    assert cache.getTree(flat_curve, 24, 60) is tree and cache.hits == 1 and cache.misses == 1
+    assert cache.getTree(flat_curve, 12, 60) is not tree
+    assert cache.getTree(make_flat_curve(0.031), 24, 60) is not tree
+
+
+def test_pruned_tree_keeps_the_oas(flat_curve):
+    bond = load_bond(CALLABLE)
+    full = tree_model().Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01, tolerance=1.0e-9)
+    pruned = tree_model(_prune_threshold=1.0e-12).Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price,
+                                                                0.01, tolerance=1.0e-9)
+    assert math.isclose(pruned, full, abs_tol=1.0e-10)
+
+
+def _grid_oas(bond, curve, grid):
+    model = OASModel()
+    model._time_grid = grid
+    return model.Calculate_OAS(bond, curve, VALUE_DATE, bond._market_price, 0.01, tolerance=1.0e-9)
+
+
+def test_time_grid_converges(flat_curve):
+    bond = load_bond(CALLABLE)
+    grid = timeGrid(0.02, 0.25, 0.02, 0.02)
+    coarse, fine = _grid_oas(bond, flat_curve, grid), _grid_oas(bond, flat_curve, grid.refine())
+    assert coarse != -1 and math.isclose(coarse, fine, abs_tol=1.0e-5)
+
+
+def test_time_grid_prices_a_bond_on_its_maturity():
+    bond = load_bond(CALLABLE)
+    curve = make_flat_curve(value_date=bond.Maturity)
+    uniform = tree_model().Calculate_Price(bond, curve, bond.Maturity, 0.01)
+    for attrs in ({'_time_grid': timeGrid()}, {'_price_precision': 1.0e-3}):
+        model = tree_model(**attrs)
+        assert model.Calculate_Price(bond, curve, bond.Maturity, 0.01) == uniform
+        assert model.Calculate_OAS(bond, curve, bond.Maturity, uniform, 0.01) == 0.01
+
+
+def test_precision_mode_matches_fine_grid(flat_curve):
+    bond = load_bond(CALLABLE)
+    model = OASModel()
+    model._price_precision = 5.0e-3
+    oas = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01, tolerance=1.0e-9)
+    report = model.get_precision_report()
+    assert report['converged'] and report['error_estimate'] <= 5.0e-3
+    assert math.isclose(report['price'], bond._market_price, abs_tol=1.0e-8)
+    fine = _grid_oas(bond, flat_curve, timeGrid(0.04, 0.5, 0.04, 0.04).refine().refine())
+    assert math.isclose(oas, fine, abs_tol=2.0e-5)
+
+
+def test_calibrated_tree_round_trips_pickle(flat_curve):
+    tree = calibratedTree(flat_curve, 24)
+    assert tree.extend(120) == 0
+    copied = pickle.loads(pickle.dumps(tree))
+    assert copied.getNumT() == tree.getNumT() and copied._data.shape[1] == tree._offsets[-1]
+    for i in range(tree.getNumT() + 1):
+        assert np.array_equal(copied.getRates(i), tree.getRates(i))
+        assert np.array_equal(copied.getGrowths(i), tree.getGrowths(i))
+        assert np.array_equal(copied.getQ(i), tree.getQ(i))
+
+
+def test_risk_matches_repricing_and_key_rates(flat_curve):
+    bond = load_bond(CALLABLE)
+    model = tree_model()
+    oas = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    risk = model.Calculate_Risk()
+    assert risk['OAS'] == oas and model.get_price() == risk['price']
+    up = tree_model().Calculate_Price(bond, flat_curve, VALUE_DATE, oas + 1.0e-4)
+    down = tree_model().Calculate_Price(bond, flat_curve, VALUE_DATE, oas - 1.0e-4)
+    assert math.isclose(risk['DV01'], (down - up) / 2.0, rel_tol=1.0e-9)
+    krd = model.Calculate_Key_Rate_Durations()
+    assert math.isclose(sum(krd['key_rate_durations']), risk['effective_duration'], rel_tol=0.01)
+
+
+def test_ladder_inverts_prices_as_full_solves(flat_curve):
+    bond = load_bond(CALLABLE)
+    cache = spreadLadderCache()
+    for price in (90.0, 95.0, 98.0, 100.0):
+        oas = cache.getOAS(bond, flat_curve, VALUE_DATE, price, 0.01, model=tree_model())
+        full = tree_model().Calculate_OAS(bond, flat_curve, VALUE_DATE, price, 0.01, tolerance=1.0e-9)
+        assert math.isclose(oas, full, abs_tol=1.0e-6)
+    assert cache.hits == 4 and cache.solves == 0
+
+
+def test_ladder_solves_in_precision_mode(flat_curve):
+    bond = load_bond(CALLABLE)
+    cache = spreadLadderCache()
+    model = tree_model(_price_precision=1.0e-3)
+    assert cache.getLadder(bond, flat_curve, VALUE_DATE, model) is None
+    oas = cache.getOAS(bond, flat_curve, VALUE_DATE, 90.0, 0.01, model=model)
+    assert cache.hits == 0 and cache.solves == 1
+    assert oas != -1 and oas == tree_model(_price_precision=1.0e-3).Calculate_OAS(bond, flat_curve, VALUE_DATE, 90.0, 0.01)
+
+
+def test_rebased_tree_matches_fresh_calibration(flat_curve):
+    cache = rateTreeCache()
+    cache.getTree(flat_curve, 24, 100)
+    # the 3 year point, inside the tree, so the steps from about 2.5 years are recalibrated
+    bumped = _bumped(flat_curve, 2, 1.0e-7)
+    rebased = cache.getTree(bumped, 24, 100)
+    assert cache.rebases == 1
+    fresh = calibratedTree(bumped, 24)
+    assert fresh.extend(100) == 0
+    for i in range(101):
+        assert np.array_equal(rebased.getRates(i), fresh.getRates(i))
+        assert np.array_equal(rebased.getQ(i), fresh.getQ(i))
@@ -0,0 +1,27 @@
+import math
+from conftest import VALUE_DATE, load_bond
+from oas import OASModel
+from pde import PDEModel
+
+CALLABLE = '459200KY6'
+
+
+def test_pde_price_matches_tree(flat_curve):
+    bond = load_bond(CALLABLE)
+    tree = OASModel()
+    tree._yearly_time_step = 24
+    tree._use_closed_form = False
+    price = tree.Calculate_Price(bond, flat_curve, VALUE_DATE, 0.0)
+    model = PDEModel()
+    model._yearly_time_step = 24
+    assert math.fabs(model.Calculate_Price(bond, flat_curve, VALUE_DATE, 0.0) - price) < 1.0e-3
+
+
+def test_pde_oas_inverts_price(flat_curve):
+    bond = load_bond(CALLABLE)
+    model = PDEModel()
+    model._yearly_time_step = 24
+    oas = model.Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01, tolerance=1.0e-9)
+    price = PDEModel()
+    price._yearly_time_step = 24
+    assert math.isclose(price.Calculate_Price(bond, flat_curve, VALUE_DATE, oas), bond._market_price, abs_tol=1.0e-6)
@@ -0,0 +1,34 @@
+import math
+import numpy as np
+from conftest import VALUE_DATE, load_bond
+from oas import OASModel
+from scenario import README_SCENARIOS, Scenario, run_scenarios
+
+
+def test_scenarios_reprice_at_shocked_curve_and_spread(flat_curve):
+    bond = load_bond('459200HU8')
+    scenarios = [Scenario('rates up', rate_shift=0.01), Scenario('spread wider', spread_scale=0.05)]
+    frame = run_scenarios([bond], VALUE_DATE, scenarios, curve=flat_curve, max_workers=1)
+    row = frame.iloc[0]
+    assert row['Error'] is None
+    oas = OASModel().Calculate_OAS(bond, flat_curve, VALUE_DATE, bond._market_price, 0.01)
+    assert math.isclose(row['OAS'], oas, abs_tol=1.0e-12)
+    up = OASModel().Calculate_Price(bond, scenarios[0].shockCurve(flat_curve), VALUE_DATE, oas)
+    assert math.isclose(row['rates up'], up, abs_tol=1.0e-9) and up < bond._market_price
+    wider = OASModel().Calculate_Price(bond, flat_curve, VALUE_DATE, oas + 0.05 * math.fabs(oas))
+    assert math.isclose(row['spread wider'], wider, abs_tol=1.0e-9)
+
+
+def test_widening_lowers_the_price_of_a_negative_oas(flat_curve):
+    bond = load_bond('459200GS4')
+    frame = run_scenarios([bond], VALUE_DATE, README_SCENARIOS, curve=flat_curve, max_workers=1)
+    row = frame.iloc[0]
+    assert row['Error'] is None and row['OAS'] < 0
+    assert row['Credit Spread Widen 5%'] < row['Price'] < row['Credit Spread Tighten 5%']
+
+
+def test_scenarios_take_an_array_of_seeds(flat_curve):
+    bonds = [load_bond(cusip) for cusip in ('459200HU8', '459200GS4')]
+    frame = run_scenarios(bonds, VALUE_DATE, README_SCENARIOS[:1], curve=flat_curve,
+                          credit_spread=np.array([0.005, -0.005]), max_workers=1)
+    assert frame['Error'].isna().all() and frame['OAS'].notna().all()